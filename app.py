@@ -1,27 +1,45 @@
+from time import time, monotonic, perf_counter
+# Startup is timed from before the heavy imports
+startup_started = perf_counter()
+
 import os
 import logging
-from random import choice, choices, shuffle
+import tempfile
 from io import BytesIO
-from datetime import datetime as dt
+from itertools import chain
+from random import choice, sample, shuffle, randrange
 from functools import wraps
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-import pytz
-from flask import Flask, render_template, send_file, abort, request, redirect, Response, url_for, session
-from google.cloud import storage
-from firebase_admin import firestore, initialize_app
-from feedgen.feed import FeedGenerator
-from pyrebase import pyrebase
+from flask import Flask, render_template, send_file, abort, request, redirect, Response, url_for, session, copy_current_request_context, g
+from werkzeug.wsgi import wrap_file
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
-from utils.md_parser import markdown_parser
-from utils.string_utils import strip_punctuation
-
-# Establish a connection to the Google Cloud Storage and Firestore
-storage_client = storage.Client()
-bucket = storage_client.bucket('website-content54321')
-initialize_app()
-db = firestore.client()
+from utils.rendering import render_markdown, render_music, artifact_name, read_artifact
+from utils.string_utils import clean_collection_name
+from utils.cache import SnapshotCache, Derived
+from utils.feed_index import FeedIndex
+from utils.hit_counter import HitCounter
+from utils.render_cache import LRUCache
+from utils.disk_cache import DiskCache
+from utils.manifest import BucketManifest
+from utils.metrics import metrics, timed, get_timings, server_timing_header
+from utils.stores import create_content_store, create_metadata_store
+from utils.id_tokens import TokenVerifier
+from utils.image_utils import IMAGE_FORMATS, CONVERTIBLE_TYPES, format_for_mimetype, snap_width, resize_image, variant_name
+
+# Content (markdown, images, music) comes from Google Cloud Storage and metadata (feed,
+# collections etc) from Firestore, or from local directories for self hosting
+CONTENT_BACKEND = os.environ.get('CONTENT_BACKEND', 'gcs')
+METADATA_BACKEND = os.environ.get('METADATA_BACKEND', 'firestore')
+content_store = create_content_store(
+    CONTENT_BACKEND,
+    bucket_name=os.environ.get('BUCKET_NAME', 'website-content54321'),
+    directory=os.environ.get('CONTENT_DIR', 'CONTENT')
+)
+metadata_store = create_metadata_store(METADATA_BACKEND, directory=os.environ.get('METADATA_DIR', 'METADATA'))
 
 # Globals
 ITEMS_PER_PAGE = 10
@@ -42,6 +60,34 @@ router = {
     'game': 'game.html'
 }
 
+FEED_CACHE_TTL = int(os.environ.get('FEED_CACHE_TTL', 300))
+FEED_CACHE_LISTEN = os.environ.get('FEED_CACHE_LISTEN', '1') == '1'
+HIT_FLUSH_INTERVAL = int(os.environ.get('HIT_FLUSH_INTERVAL', 30))
+HIT_COUNTER_SHARDS = int(os.environ.get('HIT_COUNTER_SHARDS', 1))
+RENDER_CACHE_BYTES = int(os.environ.get('RENDER_CACHE_BYTES', 32 * 1024 * 1024))
+MUSIC_CHUNK_SIZE = int(os.environ.get('MUSIC_CHUNK_SIZE', 1024 * 1024))
+MUSIC_MAX_AGE = int(os.environ.get('MUSIC_MAX_AGE', 86400))
+MANIFEST_TTL = int(os.environ.get('MANIFEST_TTL', 300))
+# How long a name that isn't in the bucket is answered with a 404 without looking again
+MISSING_BLOB_TTL = int(os.environ.get('MISSING_BLOB_TTL', 60))
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'image_cache'))
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', 128 * 1024 * 1024))
+IMAGE_MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 604800))
+IMAGE_WIDTHS = [160, 320, 640, 960, 1280, 1920]
+# Widths offered to browsers in srcset, thumbnailify makes these when the site is published
+SRCSET_WIDTHS = [320, 640, 960, 1280]
+RSS_ITEMS = 10
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 8))
+OPTIONAL_TIMEOUT = float(os.environ.get('OPTIONAL_TIMEOUT', 2.0))
+# Each optional part of a page gets its own time from when it's started, OPTIONAL_TIMEOUT unless set
+RECOMMENDATIONS_TIMEOUT = float(os.environ.get('RECOMMENDATIONS_TIMEOUT', OPTIONAL_TIMEOUT))
+NAVIGATION_TIMEOUT = float(os.environ.get('NAVIGATION_TIMEOUT', OPTIONAL_TIMEOUT))
+WARM_UP = os.environ.get('WARM_UP', '0') == '1'
+FIREBASE_PROJECT_ID = os.environ.get('FIREBASE_PROJECT_ID')
+AUTH_TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', 60))
+AUTH_REFRESH_MARGIN = int(os.environ.get('AUTH_REFRESH_MARGIN', 300))
+RSS_MAX_VARIANTS = 64
+
 app = Flask(__name__)
 
 # Set up rate limiting
@@ -51,6 +97,20 @@ limiter = Limiter(
 )
 
 
+@app.before_request
+def start_timer():
+    g.request_start = perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    """Record the request duration and report the phase timings in a Server-Timing header"""
+    if 'request_start' in g:
+        duration = perf_counter() - g.request_start
+        metrics.observe('request_duration_seconds', duration, endpoint=request.endpoint or 'none')
+        timings = get_timings() + [('total', duration)]
+        response.headers['Server-Timing'] = server_timing_header(timings)
+    return response
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('error.html', error=error), 404
@@ -66,32 +126,50 @@ def login_required(f):
         if 'user' not in session:
             return redirect(url_for('index'))
         else:
-            # Validate the auth token
+            # Validate the auth token, only going back to Firebase when it needs refreshing
             try:
-                auth.get_account_info(session['user']['idToken'])
+                claims = verify_token(session['user']['idToken'])
+                needs_refresh = claims['exp'] - time() < AUTH_REFRESH_MARGIN
             except Exception as e:
                 logging.error(e)
                 print(e)
+                claims = None
+                needs_refresh = True
+            if needs_refresh:
                 try:
-                    # If it's expired we can refresh it
+                    # If it's expired or about to expire we can refresh it
                     refresh_token = session['user']['refreshToken']
-                    res = auth.refresh(refresh_token)
+                    res = get_auth().refresh(refresh_token)
                     # Udpate session
                     session['user']['idToken'] = res['idToken']
                     session['user']['refreshToken'] = res['refreshToken']
+                    session.modified = True
                 except Exception as e:
                     print(e)
                     logging.error(e)
-                    return redirect(url_for('index'))
+                    # A token that hasn't expired yet is still good
+                    if claims is None:
+                        return redirect(url_for('index'))
         return f(*args, **kwargs)
     return wrapper
 
+def verify_token(id_token):
+    """Return the claims of a valid ID token, raising an exception if it isn't valid"""
+    if token_verifier is None:
+        # Without a project id the token can't be checked locally so ask Firebase
+        from google.auth import jwt
+        get_auth().get_account_info(id_token)
+        return jwt.decode(id_token, verify=False)
+    return token_verifier.verify(id_token)
+
 def init_auth():
+    # Pyrebase is slow to import and only needed for logging in
+    from pyrebase import pyrebase
     pyrebase_config = {
         'apiKey': os.environ.get('FIREBASE_API_KEY'),
         'authDomain': os.environ.get('FIREBASE_AUTH_DOMAIN'),
         'databaseURL': os.environ.get('FIREBASE_DATABASE_URL'),
-        'projectId': os.environ.get('FIREBASE_PROJECT_ID'),
+        'projectId': FIREBASE_PROJECT_ID,
         'storageBucket': os.environ.get('FIREBASE_STORAGE_BUCKET'),
         'messagingSenderId': os.environ.get('FIREBASE_MESSAGING_SENDER_ID'),
         'appId': os.environ.get('FIREBASE_APP_ID'),
@@ -100,142 +178,266 @@ def init_auth():
     auth = auth_app.auth()
     return auth
 
-auth = init_auth()
+auth = None
+auth_pid = None
+# Verified tokens are trusted for AUTH_TOKEN_TTL seconds before their signature is checked again
+token_verifier = TokenVerifier(FIREBASE_PROJECT_ID, ttl=AUTH_TOKEN_TTL) if FIREBASE_PROJECT_ID else None
+
+def get_auth():
+    """Create the auth client on first use, and again in a forked worker"""
+    global auth, auth_pid
+    if auth is None or auth_pid != os.getpid():
+        auth = init_auth()
+        auth_pid = os.getpid()
+    return auth
+
 app.secret_key = os.environ.get('APP_SECRET_KEY')
+# Turned off when rendering the static site
+app.config['COUNT_HITS'] = True
+
+def watch_document(collection, document):
+    """Return a watch function for SnapshotCache that listens for changes to a document"""
+    return lambda on_change: metadata_store.watch_document(collection, document, on_change)
+
+def watch_collection(collection):
+    """Return a watch function for SnapshotCache that listens for changes to any document in a collection"""
+    return lambda on_change: metadata_store.watch_collection(collection, on_change)
+
+# Listing of the bucket so existence checks and sizes don't need a request each
+bucket_manifest = SnapshotCache(timed('gcs_list')(lambda: BucketManifest(content_store.list_objects())), ttl=MANIFEST_TTL)
+
+# Every route reads the same in-memory copy of the feed
+# The listener pushes changes from the publish scripts, the TTL is a fallback if it drops
+feed_cache = SnapshotCache(
+    timed('firestore_feed')(lambda: metadata_store.get_document('feed', 'content-log')),
+    ttl=FEED_CACHE_TTL,
+    watch=watch_document('feed', 'content-log') if FEED_CACHE_LISTEN else None
+)
+# Sorted feed with postings for filtering, rebuilt only when the feed changes
+feed_index = Derived(timed('feed_index')(FeedIndex), feed_cache)
+recommendations_cache = SnapshotCache(
+    timed('firestore_recommendations')(lambda: metadata_store.get_document('recommendations', 'recommendations')),
+    ttl=FEED_CACHE_TTL,
+    watch=watch_document('recommendations', 'recommendations') if FEED_CACHE_LISTEN else None
+)
+collections_cache = SnapshotCache(
+    timed('firestore_collections')(lambda: metadata_store.list_documents('collections')),
+    ttl=FEED_CACHE_TTL,
+    watch=watch_collection('collections') if FEED_CACHE_LISTEN else None
+)
+# Serialised RSS for each filter combination, emptied when the feed changes
+rss_variants = Derived(lambda data: {}, feed_cache)
+
+@timed('firestore_hits')
+def flush_hits(hits):
+    """Write buffered hits to a hit counter shard as increments"""
+    # Shard 0 is the original hits document, the rest spread the write load
+    shard = randrange(HIT_COUNTER_SHARDS)
+    document = 'hits' if shard == 0 else f'hits_{shard}'
+    metadata_store.increment('hit_counter', document, hits)
+
+hit_counter = HitCounter(flush_hits, interval=HIT_FLUSH_INTERVAL)
+
+# Parsed metadata and rendered html, keyed by object name and generation
+render_cache = LRUCache(RENDER_CACHE_BYTES)
+# When names that weren't in the bucket can be looked up again, so probes for made up pages are answered from memory
+missing_blobs = LRUCache(1024 * 1024)
+
+# Created on first use in each worker, see get_executor
+executor = None
+executor_pid = None
+
+# Originals and resized variants of images, shared between workers
+image_cache = DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_BYTES)
 
 def register_hit(content_type, content_name):
     # Register a hit in our hitcounter collection
-    hit_counter_ref = db.collection('hit_counter').document('hits')
-    hit_counter = hit_counter_ref.get().to_dict()
+    # This is buffered and written in the background
+    if not app.config['COUNT_HITS']:
+        return
     key = os.path.join(content_type, content_name)
-    if key in hit_counter:
-        hit_counter[key] += 1
-    else:
-        hit_counter[key] = 1
-
-    hit_counter_ref.set(hit_counter)
+    hit_counter.record(key)
 
 
+@timed('gcs_metadata')
 def get_blob(blob_type, name):
-    """Get a blob from Google Cloud Storage or abort with a 404 if not found"""
+    """Get a blob from the content store or abort with a 404 if not found
+    Blobs come from the bucket manifest with their metadata loaded"""
     blob_type = content_types.get(blob_type, blob_type)
+    path = os.path.join(blob_type, name)
     try:
-        blob = bucket.blob(os.path.join(blob_type, name))
-        if not blob.exists():
-            print(f"Blob {name} not found")
-            # Render error page
-            abort(404)
-        return blob
+        blob = bucket_manifest.get().get(path)
+    except Exception as e:
+        print(e)
+        logging.error(f"Could not load bucket manifest: {e}")
+        blob = None
+    try:
+        if blob is None and not recently_missing(path):
+            # Not in the manifest, it may have been uploaded since the last refresh
+            blob = content_store.get_object(path)
+            if blob is None:
+                missing_blobs.put(path, monotonic() + MISSING_BLOB_TTL, len(path) + 64)
     except Exception as e:
         print(e)
         abort(500, e)
+    if blob is None:
+        print(f"Blob {name} not found")
+        # Render error page
+        abort(404)
+    return blob
+
+def recently_missing(path):
+    """Check if a live lookup found nothing at this path in the last MISSING_BLOB_TTL seconds"""
+    expires = missing_blobs.get(path)
+    return expires is not None and expires > monotonic()
+
+def is_stale_read(e):
+    """Check if a read failed because the object was overwritten or deleted since it was listed
+    Blobs from the manifest are pinned to the generation that was listed"""
+    return isinstance(e, FileNotFoundError) or getattr(e, 'code', None) in (404, 412)
+
+def reload_blob(blob):
+    """Get the current version of a blob whose listed version has gone, or abort with a 404
+    The manifest is reloaded too as it's out of date"""
+    print(f"{blob.name} has changed since the manifest was loaded")
+    metrics.inc('stale_reads_total')
+    bucket_manifest.invalidate()
+    fresh = content_store.get_object(blob.name)
+    if fresh is None:
+        abort(404)
+    return fresh
 
-def clean_tags(tags):
-    """Clean a tag string"""
-    return [strip_punctuation(tag).strip().lower().replace(' ', '-') for tag in tags.split(',')]
+def download_latest(blob):
+    """Download a blob, reading the current version if the listed one has been overwritten
+    Returns the blob that was read and its bytes"""
+    try:
+        with timed('gcs_download'):
+            return blob, blob.download_as_bytes()
+    except Exception as e:
+        if not is_stale_read(e):
+            raise
+    blob = reload_blob(blob)
+    with timed('gcs_download'):
+        return blob, blob.download_as_bytes()
+
+def cached_render(blob, kind, render):
+    """Return the rendered form of a blob from the render cache, or render and cache it
+    Entries are keyed by generation so a new upload is rendered fresh"""
+    key = (kind, blob.name, blob.generation)
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = load_prerendered(blob, kind)
+        if rendered is None:
+            blob, data = download_latest(blob)
+            key = (kind, blob.name, blob.generation)
+            with timed('markdown'):
+                rendered = render(data.decode('utf-8'), blob.name)
+        # Approximate the size by the rendered html and metadata
+        render_cache.put(key, rendered, len(str(rendered)))
+    return rendered
+
+def load_prerendered(blob, kind):
+    """Return the render from the artifact update_site uploads next to a blob
+    Returns None if there isn't one or it's out of date"""
+    try:
+        artifact = bucket_manifest.get().get(artifact_name(blob.name))
+        if artifact is None:
+            metrics.inc('prerendered_total', result='missing')
+            return None
+        with timed('gcs_download'):
+            data = artifact.download_as_bytes()
+        rendered = read_artifact(data, kind, blob.md5_hash)
+    except Exception as e:
+        print(e)
+        logging.error(f"Could not load the pre-rendered artifact for {blob.name}: {e}")
+        rendered = None
+    metrics.inc('prerendered_total', result='stale' if rendered is None else 'hit')
+    return rendered
 
-# TODO: These next 4 functions have a lot of redundancy - like parse_metadata and get_description
-# Get description is VERY similar to parse_markdown - can we refactor this? Yes probably
 def parse_markdown(blob):
     """Parse a markdown blob into metadata and content"""
-    # Parse the markdown content into metadata and content
-    md = blob.download_as_string().decode('utf-8')
-    # We can capture the section between --- and --- and use it as metadata
-    _, metadata, content = md.split('---', 2)
-    metadata = parse_metadata(metadata, blob.name)
-    content = markdown_parser.convert(content)
-
-    return metadata, content
+    return cached_render(blob, 'markdown', render_markdown)
 
-def parse_music(content):
+def parse_music(blob):
     """Parse a music markdown blob into metadata, content and track listing"""
-    # Split on --- to get metadata, content and track listing
-    md = content.download_as_string().decode('utf-8')
-    metadata = md.split('---')[1]
-    metadata = parse_metadata(metadata, content.name)
-    content = md.split('---')[2]
-    content = markdown_parser.convert(content)
-    track_listing = md.split('---')[3]
-    track_listing = parse_track_listing(track_listing)
-
-    # Now we need to return a dict with metadata, content and track listing
-    return {
-        'metadata': metadata,
-        'content': content,
-        'track_listing': track_listing
-    }
-
-def parse_track_listing(track_listing):
-    """Parse a track listing string into a list of dictionaries with title and file"""
-    lines = track_listing.split('\n')
-
-    # Strip any empty lines
-    lines = [line for line in lines if line]
-
-    tracks = []
-    for i in range(0, len(lines), 2):
-        title = lines[i].replace('title:', '').strip()
-        file = lines[i+1].replace('file:', '').strip()
-        tracks.append(
-            {
-                'title': title,
-                'file': file
+    return cached_render(blob, 'music', render_music)
+
+def build_navigation_table(collections):
+    """Work out the next, prev, first and last items for everything in every collection
+    Keyed by (collection, file name)"""
+    table = {}
+    for collection, data in collections.items():
+        content = (data or {}).get('content', [])
+        # Now remove file extensions from the names
+        names = [blob.split('.')[0] for blob in content]
+        for idx, blob_name in enumerate(content):
+            # Keep the first position if something is in a collection twice
+            if (collection, blob_name) in table:
+                continue
+            if len(names) == 1:
+                table[(collection, blob_name)] = None
+                continue
+            table[(collection, blob_name)] = {
+                'prev': names[idx-1] if idx > 0 else None,
+                'next': names[idx+1] if idx < len(names)-1 else None,
+                'first': names[0] if idx > 0 else None,
+                'last': names[-1] if idx < len(names)-1 else None
             }
-        )
+    return table
 
-    return tracks
+# Navigation for every collection, rebuilt when a collection changes
+navigation_table = Derived(build_navigation_table, collections_cache)
 
-def get_collection_navigation(metadata, blob_name):
-    """Return next, prev, first and last items in a collection of content"""
+def get_collection_navigation(metadata, blob_name, table=None):
+    """Return next, prev, first and last items in a collection of content
+    table is the navigation table if it has already been loaded"""
     # Get the raw file name from the blob name
     blob_name = blob_name.split('/')[-1]
     # Get the collection from metadata
     collection = metadata['collection']
     # Strip punctuation, lowercase, replace spaces with underscores
-    collection = strip_punctuation(collection.lower()).replace(' ', '_')
-    # Request the collection from Firestore
-    data = db.collection('collections').document(collection).get().to_dict()
-    idx = data['content'].index(blob_name)
-
-    # Now remove file extensions from the names
-    data['content'] = [blob.split('.')[0] for blob in data['content']]
-
-    if len(data['content']) == 1:
-        return None
+    collection = clean_collection_name(collection)
+    table = navigation_table.get() if table is None else table
+    return table.get((collection, blob_name))
+
+def build_recommendation_table(recs, feed):
+    """Resolve the recommendations document into cards for each blob
+    Returns the table of blob name to recommended cards and the pool of all cards for random picks"""
+    # One card per location with the url formatted for linking
+    # Locations in the feed have a leading slash, the recommendations don't
+    cards = {}
+    for v in feed.values():
+        card = dict(v)
+        arg = card['url'].split('/')[-1]
+        card['url'] = url_for('content', content_type=card['type'], content_name=arg)
+        cards[card['location'].lstrip('/')] = card
+
+    table = {}
+    for blob_name, locations in (recs or {}).items():
+        table[blob_name] = [cards[location.lstrip('/')] for location in locations if location.lstrip('/') in cards]
 
     return {
-        'prev': data['content'][idx-1] if idx > 0 else None,
-        'next': data['content'][idx+1] if idx < len(data['content'])-1 else None,
-        'first': data['content'][0] if idx > 0 else None,
-        'last': data['content'][-1] if idx < len(data['content'])-1 else None
+        'table': table,
+        'pool': list(cards.values())
     }
 
-def get_recommendations(blob_name):
-    recs = db.collection('recommendations').document('recommendations').get().to_dict()
-    feed = db.collection('feed').document('content-log').get().to_dict()
+# Recommendation cards for each blob, rebuilt when the recommendations or the feed change
+recommendation_tables = Derived(build_recommendation_table, recommendations_cache, feed_cache)
+
+def get_recommendations(blob_name, num_random=3):
     try:
-        recs = recs[blob_name]
-        rec_details = []
-        for_popping = []
-        # Loop over and find metadata
-        for k, v in feed.items():
-            if v['location'] in recs:
-                for_popping.append(k)
-                rec_details.append(v)
-
-
-        # Pop the recommendations from the feed
-        for k in for_popping:
-            feed.pop(k)
-
-        # Also pick out 3 random pages from the feed
-        random_pages = choices(list(feed.keys()), k=3)
-        random_pages = [feed[page] for page in random_pages]
-        rec_details.extend(random_pages)
-        # Format the urls
-        for page in rec_details:
-            arg = page['url'].split('/')[-1]
-            page['url'] = url_for('content', content_type=page['type'], content_name=arg)
+        recommendation_table = recommendation_tables.get()
+        rec_details = recommendation_table['table'][blob_name]
+        pool = recommendation_table['pool']
+
+        # Also pick out 3 random pages that aren't already recommended or this page
+        # Sampling a few extra means we always have enough after skipping those
+        candidates = sample(pool, min(len(pool), num_random + len(rec_details) + 1))
+        random_pages = [
+            page for page in candidates
+            if all(page is not rec for rec in rec_details) and page['location'].lstrip('/') != blob_name
+        ]
+        rec_details = rec_details + random_pages[:num_random]
 
         # Randomise the recommendations
         shuffle(rec_details)
@@ -255,87 +457,24 @@ def get_og_tags(metadata):
     return og_tags if og_tags else None
 
 
-def parse_metadata(metadata, blob_name):
-    """Parse the metadata section of a markdown file and return a dictionary"""
-    # Parse the metadata section of the markdown file and return a dictionary
-    metadata_dict = {}
-    for line in metadata.split('\n'):
-        if line:
-            split_line = line.split(':')
-            key = split_line[0].strip()
-            # Remove the quotes
-            value = ":".join(split_line[1:]).strip()
-            metadata_dict[key.strip()] = value
-
-    # Add a key for filename for linking
-    metadata_dict['filename'] = blob_name.split('/')[-1].split('.')[0]
-    try:
-        metadata_dict['url'] = os.path.join(metadata_dict['type'], metadata_dict['filename'])
-    except:
-        print(f"Error parsing metadata for {blob_name}")
-
-    return metadata_dict
-
 def get_random_page():
-    feed = db.collection('feed').document('content-log')
-    data = feed.get().to_dict()
+    data = feed_cache.get()
     random_page = choice(list(data.keys()))
     url = data[random_page]['url']
 
     return url
 
 def get_feed(filters={}, page=1):
-    """Get a page of the feed from Firestore
+    """Get a page of the feed from the feed index
     Filters is a dictionary of filters to be applied to the feed based on doc metadata"""
-    # Get the feed from Firestore
-    feed = db.collection('feed').document('content-log')
-    data = feed.get().to_dict()
-
-    # Sort by key (timestamp) desc
-    # Order is not guaranteed in Firestore so we need to sort it here
-    data = dict(sorted(data.items(), key=lambda item: item[0], reverse=True))
-
-    # Loop over the data and filter it
+    # Look up the page in the feed index
     start = (page-1)*ITEMS_PER_PAGE
     end = page*ITEMS_PER_PAGE
-    feed = []
-    feed_length = 0
-    feed_index = 0
-    for k, v in data.items():
-        # Filters should contain a key (metadata value) and a list of possible values
-        pass_filter = True
-        for key, values in filters.items():
-            # Tags are a list so we need to check if all the values are in the tags
-            # We want at least ONE tag to be in the tags
-            if key == 'tags':
-                tags = clean_tags(v[key])
-                if not any(tag in values for tag in tags):
-                    pass_filter = False
-                    break
-            elif key == 'collection':
-                # Process the collection name
-                clean_collection_name = strip_punctuation(v[key]).replace(' ', '_').lower()
-                if clean_collection_name not in values:
-                    pass_filter = False
-                    break
-            elif v[key] not in values:
-                pass_filter = False
-                break
-
-        if pass_filter:
-            feed_index += 1
-            if feed_index > start and feed_index <= end:
-                feed_length += 1
-                # Clean tags
-                if 'tags' in v:
-                    v['tags'] = clean_tags(v['tags'])
-                v['clean_collection'] = strip_punctuation(v['collection']).replace(' ', '_').lower()
-                feed.append(v)
-                feed[-1]['date'] = k
+    feed, feed_index_count = feed_index.get().query(filters, start, end)
 
-    # Feed index contains the number of items that pass the filter
-    num_pages = feed_index // ITEMS_PER_PAGE
-    num_pages += 1 if feed_index % ITEMS_PER_PAGE else 0
+    # Feed index count contains the number of items that pass the filter
+    num_pages = feed_index_count // ITEMS_PER_PAGE
+    num_pages += 1 if feed_index_count % ITEMS_PER_PAGE else 0
 
 
     return {
@@ -350,64 +489,283 @@ def get_feed(filters={}, page=1):
         }
     }
 
+@app.template_filter('srcset')
+def srcset(url):
+    """Build a srcset of the resized versions of one of our images so browsers can pick a size"""
+    if not url or not url.startswith('/assets/images/'):
+        return ''
+    return ', '.join(f'{url}?w={width} {width}w' for width in SRCSET_WIDTHS)
+
 # Data routes
+def negotiate_image_format(content_type):
+    """Pick the format to send an image in from the fmt parameter or the Accept header
+    Returns the format name, or None to send the original format"""
+    fmt = request.args.get('fmt', '').lower()
+    fmt = 'jpeg' if fmt == 'jpg' else fmt
+    if fmt in IMAGE_FORMATS:
+        return fmt
+    # Offer webp to browsers that accept it
+    if content_type in ('image/jpeg', 'image/png') and 'image/webp' in request.accept_mimetypes.values():
+        return 'webp'
+    return None
+
 @app.route('/assets/images/<img_name>')
 def serve_image(img_name):
+    blob = get_blob('images', img_name)
+
+    # Only jpeg, png and webp get resized or converted, anything else is sent as is
+    width = None
+    fmt = None
+    if blob.content_type in CONVERTIBLE_TYPES:
+        width = request.args.get('w', type=int)
+        width = snap_width(width, IMAGE_WIDTHS) if width and width > 0 else None
+        fmt = negotiate_image_format(blob.content_type)
+        if fmt == format_for_mimetype(blob.content_type):
+            fmt = None
+    etag = image_etag(blob, width, fmt)
+
+    headers = {'Cache-Control': f'public, max-age={IMAGE_MAX_AGE}'}
+    if blob.content_type in CONVERTIBLE_TYPES and 'fmt' not in request.args:
+        headers['Vary'] = 'Accept'
+
+    if is_not_modified(etag, blob.updated):
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    mimetype = IMAGE_FORMATS[fmt][1] if fmt else blob.content_type or 'application/octet-stream'
+    # Originals in a local content store are sent straight from disk
+    path = content_store.local_path(blob) if not (width or fmt) else None
+    img_file = open_image(path or image_cache.get(f'{blob.name}:{etag}'))
+    if img_file is None:
+        img_file, mimetype, etag, blob = make_image(blob, width, fmt)
+
+    metrics.inc('image_bytes_served_total', img_file.seek(0, os.SEEK_END))
+    img_file.seek(0)
+    response = send_file(img_file, mimetype=mimetype, conditional=False, etag=False)
+    response.headers.update(headers)
+    response.set_etag(etag)
+    response.last_modified = blob.updated
+    return response
+
+def open_image(path):
+    """Open a cached image to send, or return None if it isn't there
+    Open before sending, another worker could evict the file but the handle stays valid"""
+    if path is None:
+        return None
     try:
-        blob = get_blob('images', img_name)
+        return open(path, 'rb')
+    except FileNotFoundError:
+        # Evicted since it was looked up
+        return None
 
-        # Use send_file to send the image file directly
-        img_bytes = blob.download_as_bytes()
-        img_file = BytesIO(img_bytes)
-        img_file.seek(0)
-        return send_file(img_file, mimetype=blob.content_type)
+def image_etag(blob, width, fmt):
+    """Etag of an image at a width and in a format, None meaning the original's"""
+    return f'{blob.generation}-{width or "full"}-{fmt or "original"}'
+
+def make_image(blob, width, fmt):
+    """Download an image, resize it if asked and cache it
+    Returns a file to send, its mimetype and etag and the blob that was read,
+    images too big for the cache are sent from memory"""
+    mimetype = IMAGE_FORMATS[fmt][1] if fmt else blob.content_type or 'application/octet-stream'
+    # Variants made when the site was published save resizing here
+    pregenerated = load_variant(blob, width, fmt) if width else None
+    if pregenerated is not None:
+        # Variants are named by the original's hash so they're never overwritten
+        with timed('gcs_download'):
+            img_bytes = pregenerated.download_as_bytes()
+    else:
+        blob, img_bytes = download_latest(blob)
+    if (width or fmt) and pregenerated is None:
+        try:
+            with timed('image_resize'):
+                img_bytes, mimetype = resize_image(img_bytes, width, fmt)
+        except Exception as e:
+            # Send the original rather than nothing, cached and tagged as the original
+            logging.error(f"Could not resize {blob.name}: {e}")
+            print(e)
+            mimetype = blob.content_type or 'application/octet-stream'
+            width, fmt = None, None
+    etag = image_etag(blob, width, fmt)
+    img_file = open_image(image_cache.put(f'{blob.name}:{etag}', img_bytes))
+    return img_file or BytesIO(img_bytes), mimetype, etag, blob
+
+def load_variant(blob, width, fmt):
+    """Return the variant of an image that thumbnailify made for this width and format, or None"""
+    fmt = fmt or format_for_mimetype(blob.content_type)
+    try:
+        variant = bucket_manifest.get().get(variant_name(blob.name, blob.md5_hash, width, fmt)) if blob.md5_hash else None
     except Exception as e:
-        abort(500, e)
+        print(e)
+        logging.error(f"Could not look up variants of {blob.name}: {e}")
+        variant = None
+    metrics.inc('image_variants_total', result='missing' if variant is None else 'hit')
+    return variant
+
+def is_not_modified(etag, last_modified):
+    """Check the request's conditional headers against a resource's etag and modified date"""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+def get_byte_range(file_size, etag, last_modified):
+    """Return the inclusive (start, end) byte range requested, or None for the whole file
+    Raises ValueError if the range can't be satisfied"""
+    byte_range = request.range
+    # Multiple ranges aren't supported so we send the whole file
+    if not byte_range or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+        return None
+
+    # If-Range means only send the range if the file hasn't changed
+    if_range = request.if_range
+    if if_range.etag and if_range.etag != etag:
+        return None
+    if if_range.date and (not last_modified or last_modified.replace(microsecond=0) != if_range.date):
+        return None
+
+    # Werkzeug gives us a half open range, with a negative start for a suffix (bytes=-N)
+    start, stop = byte_range.ranges[0]
+    if stop is None:
+        if start < 0:
+            start = max(file_size + start, 0)
+        stop = file_size
+    stop = min(stop, file_size)
+    if start >= stop:
+        raise ValueError(f"Range {start}-{stop} not satisfiable for {file_size} bytes")
+
+    return start, stop - 1
+
+def stream_blob(blob, start, end, chunk_size):
+    """Yield bytes start to end (inclusive) of a blob in chunks"""
+    # Small ranges only fetch what was asked for rather than a whole chunk
+    chunk_size = max(1, min(chunk_size, end - start + 1))
+    # Pin the generation so a re-upload mid stream can't splice two files together
+    # Local blobs ignore it
+    with blob.open('rb', chunk_size=chunk_size, if_generation_match=blob.generation) as reader:
+        reader.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = reader.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            metrics.inc('music_bytes_served_total', len(chunk))
+            yield chunk
 
 @app.route('/assets/music/<filename>')
 def get_music(filename):
+    # get_blob already has the size and etag so there's no need to reload
     blob = get_blob('music', filename)
+    try:
+        return music_response(blob)
+    except Exception as e:
+        if not is_stale_read(e):
+            raise
+    # Overwritten since the manifest was loaded, the size and etag may have changed too
+    return music_response(reload_blob(blob))
 
-    # Load blob to get the size
-    blob.reload()
-
+def music_response(blob):
+    """Send all of a music blob or the requested range"""
     file_size = blob.size
-    print(f"File size: {file_size}")
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f'public, max-age={MUSIC_MAX_AGE}',
+    }
+
+    if is_not_modified(blob.etag, blob.updated):
+        response = Response(status=304, headers=headers)
+        response.set_etag(blob.etag)
+        return response
 
     # Partial content handling
-    range_header = request.headers.get('Range', None)
-    if not range_header:
-        return Response(
-            blob.download_as_bytes(),
-            200,
-            mimetype='audio/mpeg',
-            headers={'Content-Length': str(file_size)}
-        )
-
-    byte_range = range_header.strip().split('=')[1]
-    byte_range = byte_range.split('-')
-    start = int(byte_range[0])
-    end = int(byte_range[1]) if byte_range[1] else file_size - 1
-
-    if start >= file_size or end >= file_size:
-        abort(416)
-
-    chunk = blob.download_as_bytes(start=start, end=end + 1)
+    try:
+        byte_range = get_byte_range(file_size, blob.etag, blob.updated)
+    except ValueError:
+        return Response(status=416, headers={'Content-Range': f'bytes */{file_size}'})
+
+    if byte_range:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+    else:
+        start, end = 0, file_size - 1
+        status = 200
+    headers['Content-Length'] = str(end - start + 1)
+
+    # Stream the file in chunks rather than loading it all into memory
+    path = content_store.local_path(blob)
+    if path and end == file_size - 1:
+        # Local files that are read to the end can go out through the server's sendfile
+        music_file = open(path, 'rb')
+        music_file.seek(start)
+        body = wrap_file(request.environ, music_file)
+        metrics.inc('music_bytes_served_total', end - start + 1)
+    else:
+        chunks = stream_blob(blob, start, end, MUSIC_CHUNK_SIZE)
+        # Read the first chunk now so a version that has gone is found before the headers are sent
+        body = chain([next(chunks, b'')], chunks)
     response = Response(
-        chunk,
-        206,
+        body,
+        status,
         mimetype='audio/mpeg',
-        headers={
-            'Content-Range': f'bytes {start}-{end}/{file_size}',
-            'Accept-Ranges': 'bytes',
-            'Content-Length': str(end - start + 1),
-        }
+        headers=headers,
+        direct_passthrough=True
     )
+    response.set_etag(blob.etag)
+    response.last_modified = blob.updated
     return response
 
+def get_executor():
+    """Return the thread pool for fetching optional parts of a page, one per process"""
+    global executor, executor_pid
+    if executor_pid != os.getpid():
+        executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS)
+        executor_pid = os.getpid()
+    return executor
+
+def submit(fn, *args):
+    """Run a function on the thread pool with the current request context"""
+    # The thread gets its own g so hand it our timings list
+    timings = get_timings()
+
+    @copy_current_request_context
+    def run():
+        g.timings = timings
+        return fn(*args)
+
+    future = get_executor().submit(run)
+    future.submitted_at = monotonic()
+    return future
+
+def get_result(future, timeout, name, default=None):
+    """Wait for a future until timeout seconds after it was submitted, returning the default if it is late or fails
+    The page is still rendered without it"""
+    try:
+        return future.result(timeout=max(future.submitted_at + timeout - monotonic(), 0))
+    except FutureTimeoutError:
+        logging.warning(f"Timed out getting {name}")
+    except Exception as e:
+        print(e)
+        logging.error(f"Could not get {name}: {e}")
+    return default
+
 # Content routes
 @app.route('/<content_type>/<content_name>')
 def content(content_type, content_name):
+    # Use this to get the correct template
+    if not router.get(content_type):
+        abort(404)
+
+    # Recommendations and navigation don't depend on the markdown so fetch them while we parse it
+    blob_name = os.path.join(content_types.get(content_type, content_type), content_name + '.md')
+    recommendations_future = submit(get_recommendations, blob_name)
+    # Navigation needs the collection from the metadata, this loads the table in the meantime
+    navigation_table_future = submit(navigation_table.get)
+
     blob = get_blob(content_type, content_name + '.md')
 
     # Any special handling for music or video etc
@@ -425,13 +783,13 @@ def content(content_type, content_name):
     else:
         metadata, content = parse_markdown(blob)
 
-    # Use this to get the correct template
-    if not router.get(content_type):
-        abort(404)
-
     # Register a hit
     register_hit(content_type, content_name)
 
+    # Finding this page in the table is only a lookup once it has loaded
+    table = get_result(navigation_table_future, NAVIGATION_TIMEOUT, 'navigation')
+    navigation = get_collection_navigation(metadata, blob.name, table) if table is not None else None
+
     # Create our kwargs for the template
     kwargs = {
         'content': content,
@@ -440,8 +798,8 @@ def content(content_type, content_name):
         'date': metadata['date'],
         'type': content_type,
         'collection': metadata['collection'],
-        'navigation': get_collection_navigation(metadata, blob.name),
-        'recommendations': get_recommendations(blob.name),
+        'navigation': navigation,
+        'recommendations': get_result(recommendations_future, RECOMMENDATIONS_TIMEOUT, 'recommendations'),
         'description': metadata.get('description', None),
         'video_id': metadata.get('video_id', None),
         'cover_art': metadata.get('og_image', None),
@@ -451,19 +809,16 @@ def content(content_type, content_name):
         'hover_text': metadata.get('hover_text', None),
     }
 
-    return render_template(router[content_type], **kwargs)
+    with timed('template'):
+        return render_template(router[content_type], **kwargs)
 
 
-# Static routes
-@app.route('/')
-def index():
-    page = request.args.get('page', 1, type=int)
+def get_filters():
+    """Create a feed filter dictionary from the tags, type and collection request args"""
     tags = request.args.get('tags', None)
     content_type = request.args.get('type', None)
     collection = request.args.get('collection', None)
 
-    register_hit('homepage', 'index')
-
     # Split them on commas
     tags = tags.split(',') if tags else None
     content_type = content_type.split(',') if content_type else None
@@ -472,15 +827,22 @@ def index():
     # Clean collection names (shouldn't need to do this because we construct the GET request ourselves but just in case)
     collection = [c.lower() for c in collection] if collection else None
 
-
-    # Create a filter dictionary
-    filters = {
+    return {
         k: v for k, v in {
             'tags': tags,
             'type': content_type,
             'collection': collection
         }.items() if v
     }
+
+# Static routes
+@app.route('/')
+def index():
+    page = request.args.get('page', 1, type=int)
+
+    register_hit('homepage', 'index')
+
+    filters = get_filters()
     # Get the first page of the feed
     feed_dict = get_feed(filters=filters, page=page)
     feed = feed_dict['feed']
@@ -491,7 +853,8 @@ def index():
         'og:type': 'website',
         'og:image': '/assets/images/edwardatkin.jpg'
     }
-    return render_template('index.html', feed=feed, pagination=pagination, og_tags=og_tags)
+    with timed('template'):
+        return render_template('index.html', feed=feed, pagination=pagination, og_tags=og_tags)
 
 # Static routes for misc docs like about, browse by collection, etc
 @app.route('/<doc>')
@@ -507,7 +870,8 @@ def about(doc):
         'og:type': 'website',
         'og:image': '/assets/images/edwardatkin.jpg'
     }
-    return render_template('misc_doc.html', content=content, og_tags=og_tags)
+    with timed('template'):
+        return render_template('misc_doc.html', content=content, og_tags=og_tags)
 
 @app.route('/random')
 def random():
@@ -517,6 +881,33 @@ def random():
     # Redirect
     return redirect(url)
 
+# Hits from statically exported pages
+@app.route('/hits/<content_type>/<content_name>', methods=['POST'])
+@limiter.limit('60 per minute')
+def hit_beacon(content_type, content_name):
+    # Only count pages that exist so made up names can't fill the hits document
+    if not is_known_page(content_type, content_name):
+        abort(404)
+    register_hit(content_type, content_name)
+    return '', 204
+
+def is_known_page(content_type, content_name):
+    """Check a page is one the app would register a hit for"""
+    if content_type == 'homepage':
+        if content_name in ('index', 'random'):
+            return True
+        blob_name = f'{content_name}.md'
+    elif content_type in router:
+        blob_name = os.path.join(content_types.get(content_type, content_type), content_name + '.md')
+    else:
+        return False
+    try:
+        return blob_name in bucket_manifest.get()
+    except Exception as e:
+        print(e)
+        logging.error(f"Could not load bucket manifest: {e}")
+        return False
+
 @app.route('/login')
 def login_get():
     return render_template('login.html')
@@ -538,7 +929,7 @@ def login_post():
     password = request.form['password']
 
     try:
-        user = auth.sign_in_with_email_and_password(email, password)
+        user = get_auth().sign_in_with_email_and_password(email, password)
         session['user'] = user
         return redirect(url_for('admin'))
     except Exception as e:
@@ -546,65 +937,87 @@ def login_post():
         logging.error(e)
         return redirect(url_for('index'))
 
+def get_cache_stats():
+    """Return hit ratios and sizes for the in-process caches, keyed by metric labels"""
+    hit_ratios = {}
+    sizes = {}
+    for name, cache in [('feed', feed_cache), ('recommendations', recommendations_cache),
+                        ('collections', collections_cache), ('manifest', bucket_manifest)]:
+        lookups = cache.hits + cache.misses
+        hit_ratios[(('cache', name),)] = cache.hits / lookups if lookups else 0.0
+    for name, cache in [('render', render_cache), ('image', image_cache)]:
+        stats = cache.stats()
+        hit_ratios[(('cache', name),)] = stats['hit_ratio']
+        sizes[(('cache', name),)] = stats['bytes']
+    return hit_ratios, sizes
+
+metrics.add_gauge('cache_hit_ratio', lambda: get_cache_stats()[0], 'Fraction of cache lookups that were hits')
+metrics.add_gauge('cache_bytes', lambda: get_cache_stats()[1], 'Approximate bytes held by each cache')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Metrics are per worker process
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # RSS
 @app.route('/rss')
 def rss():
     base_url = os.environ.get('BASE_URL', 'https://homepage-mkmtu6ld5q-nw.a.run.app/')
+    filters = get_filters()
 
-    feed = FeedGenerator()
-    feed.id(base_url)
-    feed.title('Edward Atkin\'s Homepage')
-    feed.link(href=base_url, rel='alternate')
-    feed.description('The personal website of Edward Atkin')
-    feed.language('en')
-    feed.ttl(3600)
-
-    # Get the feed from Firestore
-    data = db.collection('feed').document('content-log').get().to_dict()
-    # Sort
-    data = dict(sorted(data.items(), key=lambda item: item[0], reverse=True))
-
-    # Get the latest date for the feed last build date
-    latest_date = list(data.keys())[0]
-    # Parse it
-    latest_date = dt.strptime(latest_date, "%Y-%m-%d %H:%M:%S")
-    # Timezone
-    latest_date = pytz.timezone('Europe/London').localize(latest_date)
-
-    # Now set the last build date
-    feed.lastBuildDate(latest_date)
-
-    num_items = 10
-
-    # Feedgen expects oldest first so we need to reverse the data shrug emoji
-    reversed_data = list(data.items())[:num_items][::-1]
-
-    for date, v in reversed_data:
-        # Create an entry for each item in the feed
-        entry = feed.add_entry()
-        entry.id(f'{base_url}{v["url"]}')
-        entry.title(v['title'])
-        entry.link(href=f'{base_url}{v["url"]}', rel='alternate')
-        entry.description(v['description'])
-        pub_date = dt.strptime(date, "%Y-%m-%d %H:%M:%S")
-        # Localise to London
-        pub_date = pytz.timezone('Europe/London').localize(pub_date)
-        entry.pubDate(pub_date)
-
-        if 'og_image' in v:
-            # Ext should be jpg or png - get mimetype from the extension
-            ext = v['og_image'].split('.')[-1]
-            mime_type = f'image/{ext}'.lower()
-            # If it says jpg then it should be jpeg
-            if ext.lower() == 'jpg':
-                mime_type = 'image/jpeg'
-            entry.enclosure(f'{base_url[:-1]}{v["og_image"]}', 0, mime_type)
-
-    return Response(
-        feed.rss_str(pretty=True),
-        mimetype='application/rss+xml'
-    )
+    # Each filter combination is built once per version of the feed
+    variants = rss_variants.get()
+    key = tuple(sorted((k, tuple(sorted(v))) for k, v in filters.items()))
+    if key in variants:
+        rss_str, etag, last_modified = variants[key]
+    else:
+        # Feedgen is only imported when a feed is first built
+        from utils.rss import build_rss
+        index = feed_index.get()
+        entries, _ = index.query(filters, 0, RSS_ITEMS)
+        newest = index.entries[0]['date'] if index.entries else None
+        rss_str, etag, last_modified = build_rss(entries, base_url, newest)
+        # Don't let arbitrary query strings grow the cache forever
+        if len(variants) < RSS_MAX_VARIANTS:
+            variants[key] = (rss_str, etag, last_modified)
+
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        response = Response(rss_str, mimetype='application/rss+xml')
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+def warm_up():
+    """Load the manifest, feed, lookup tables and templates so the first request doesn't wait for them"""
+    started = perf_counter()
+    # The recommendation cards use url_for
+    with app.test_request_context():
+        for name, prime in [('manifest', bucket_manifest.get), ('feed', feed_index.get),
+                            ('recommendations', recommendation_tables.get), ('navigation', navigation_table.get)]:
+            try:
+                prime()
+            except Exception as e:
+                print(e)
+                logging.error(f"Could not warm up {name}: {e}")
+        for template in {*router.values(), 'index.html', 'misc_doc.html', 'error.html'}:
+            app.jinja_env.get_template(template)
+    startup_times['warm_up'] = perf_counter() - started
+    print(f"Warm up took {startup_times['warm_up']:.2f}s")
+
+startup_times = {'import': perf_counter() - startup_started}
+metrics.add_gauge(
+    'startup_seconds',
+    lambda: {(('phase', phase),): seconds for phase, seconds in startup_times.items()},
+    'Seconds spent importing the app and warming its caches'
+)
+print(f"App imported in {startup_times['import']:.2f}s")
 
+if WARM_UP:
+    # In the background so the worker can take requests straight away
+    Thread(target=warm_up, daemon=True).start()
 
 
 if __name__ == '__main__':
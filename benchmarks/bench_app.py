@@ -0,0 +1,414 @@
+# Benchmark the app's routes against in-memory content and metadata stores
+# Every store call sleeps for a configurable latency to stand in for a GCS or Firestore round trip,
+# and the corpus is generated so the feed can be sized from a hundred to tens of thousands of entries
+#
+# This script is expected to be run from the root of the project
+# E.g. python -m benchmarks.bench_app --entries 5000 --requests 200 --workers 2
+# Save results with --output results.json and compare a later run with --baseline results.json
+import os
+import io
+import sys
+import json
+import copy
+import hashlib
+import argparse
+import resource
+import tempfile
+from random import Random
+from time import sleep, perf_counter
+from datetime import datetime, timedelta, timezone
+from multiprocessing import Pool
+
+from utils.stores import ContentStore, MetadataStore
+from utils.string_utils import clean_tags
+from utils.hashing import md5_base64
+
+TYPES = ['blog', 'comic', 'music', 'project', 'game']
+FOLDERS = {'blog': 'blogs', 'comic': 'comics', 'music': 'music', 'project': 'projects', 'game': 'games'}
+MUSIC_FILE = 'music/track.mp3'
+MUSIC_SIZE = 8 * 1024 * 1024
+MUSIC_RANGE = 256 * 1024
+IMAGE_FILE = 'images/cover.png'
+
+
+class FakeBlob:
+    """An in-memory object with the parts of the GCS Blob interface the app uses"""
+    def __init__(self, name, data, content_type, latency):
+        self.name = name
+        self.data = data
+        self.latency = latency
+        self.size = len(data)
+        self.generation = 1
+        self.etag = hashlib.md5(data).hexdigest()
+        self.md5_hash = md5_base64(data)
+        self.updated = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.content_type = content_type
+
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        sleep(self.latency)
+        start = start or 0
+        # End is inclusive like GCS
+        return self.data[start:None if end is None else end + 1]
+
+    def download_as_string(self, **kwargs):
+        return self.download_as_bytes(**kwargs)
+
+    def open(self, mode='rb', **kwargs):
+        sleep(self.latency)
+        return io.BytesIO(self.data)
+
+
+class FakeContentStore(ContentStore):
+    def __init__(self, objects, latency):
+        self.latency = latency
+        self.objects = {
+            name: FakeBlob(name, data, content_type, latency)
+            for name, (data, content_type) in objects.items()
+        }
+
+    def get_object(self, name):
+        sleep(self.latency)
+        return self.objects.get(name)
+
+    def list_objects(self):
+        # Listings come back a thousand objects a page
+        sleep(self.latency * (len(self.objects) // 1000 + 1))
+        return list(self.objects.values())
+
+
+class FakeMetadataStore(MetadataStore):
+    def __init__(self, documents, latency):
+        self.latency = latency
+        self.documents = documents
+
+    def get_document(self, collection, document):
+        sleep(self.latency)
+        # Copy so callers get fresh data like a real read
+        return copy.deepcopy(self.documents.get(collection, {}).get(document))
+
+    def list_documents(self, collection):
+        sleep(self.latency)
+        return copy.deepcopy(self.documents.get(collection, {}))
+
+    def set_document(self, collection, document, data, merge=False):
+        sleep(self.latency)
+        docs = self.documents.setdefault(collection, {})
+        docs[document] = {**(docs.get(document) or {}), **data} if merge else dict(data)
+
+    def increment(self, collection, document, deltas):
+        sleep(self.latency)
+        doc = self.documents.setdefault(collection, {}).setdefault(document, {})
+        for key, count in deltas.items():
+            doc[key] = doc.get(key, 0) + count
+
+
+def build_corpus(entries, seed=0):
+    """Generate bucket objects and Firestore documents for a site with this many feed entries
+    Returns (objects, documents, urls) where objects maps names to (data, content type)"""
+    rng = Random(seed)
+    tags = [f'Tag {i}' for i in range(50)]
+    collections = [f'Collection {i}' for i in range(max(1, entries // 20))]
+    start = datetime(2024, 1, 1)
+
+    objects = {}
+    feed = {}
+    collection_docs = {}
+    locations = []
+    urls = []
+    for i in range(entries):
+        content_type = TYPES[i % len(TYPES)]
+        name = f'post{i}'
+        location = f'{FOLDERS[content_type]}/{name}.md'
+        collection = rng.choice(collections)
+        entry_tags = ', '.join(rng.sample(tags, 3))
+        timestamp = start + timedelta(hours=i)
+        metadata = {
+            'title': f'Post {i}',
+            'author': 'Benchmark',
+            'date': timestamp.strftime('%Y-%m-%d'),
+            'tags': entry_tags,
+            'description': f'Description of post {i}',
+            'type': content_type,
+            'collection': collection,
+            'og_image': f'/assets/{IMAGE_FILE}',
+        }
+        header = '\n'.join(f'{k}: {v}' for k, v in metadata.items())
+        body = '\n\n'.join(f'Paragraph {p} of post {i} with some **bold** and *italic* text.' for p in range(20))
+        markdown = f'---\n{header}\n---\n# Post {i}\n\n{body}\n'
+        if content_type == 'music':
+            markdown += f'---\ntitle: Track one\nfile: /assets/{MUSIC_FILE}\ntitle: Track two\nfile: /assets/{MUSIC_FILE}\n'
+        objects[location] = (markdown.encode('utf-8'), 'text/markdown')
+
+        feed[timestamp.strftime('%Y-%m-%d %H:%M:%S')] = {
+            **metadata,
+            'location': f'/{location}',
+            'url': f'{content_type}/{name}',
+            'filename': name,
+        }
+        clean_name = collection.lower().replace(' ', '_')
+        collection_docs.setdefault(clean_name, {'content': []})['content'].append(f'{name}.md')
+        locations.append(location)
+        urls.append(f'/{content_type}/{name}')
+
+    recommendations = {location: rng.sample(locations, min(5, len(locations))) for location in locations}
+
+    objects['about.md'] = (b'---\ntitle: About\n---\nAbout the benchmark site\n', 'text/markdown')
+    objects[MUSIC_FILE] = (bytes(rng.getrandbits(8) for _ in range(4096)) * (MUSIC_SIZE // 4096), 'audio/mpeg')
+    objects[IMAGE_FILE] = (make_image(), 'image/png')
+
+    documents = {
+        'feed': {'content-log': feed},
+        'collections': collection_docs,
+        'recommendations': {'recommendations': recommendations},
+        'hit_counter': {},
+    }
+    return objects, documents, urls
+
+def make_image():
+    from PIL import Image
+    # Noise so the PNG is a realistic size rather than compressing to nothing
+    image = Image.merge('RGB', [Image.effect_noise((1600, 1200), sigma) for sigma in (32, 48, 64)])
+    data = io.BytesIO()
+    image.save(data, 'PNG')
+    return data.getvalue()
+
+def get_routes(rng, urls, documents):
+    """Return route name -> function returning (path, headers, expected status)"""
+    feed = documents['feed']['content-log']
+    collections = sorted(documents['collections'])
+    # Tags are filtered on in their cleaned form, the same as the links on the index page
+    tags = sorted({tag for v in feed.values() for tag in clean_tags(v['tags'])})
+    pages = max(1, len(feed) // 10)
+
+    def music_range():
+        start = rng.randrange(0, MUSIC_SIZE - MUSIC_RANGE)
+        return f'/assets/{MUSIC_FILE}', {'Range': f'bytes={start}-{start + MUSIC_RANGE - 1}'}, 206
+
+    return {
+        'index': lambda: ('/', {}, 200),
+        'index_page': lambda: (f'/?page={rng.randint(1, pages)}', {}, 200),
+        'index_type': lambda: (f'/?type={rng.choice(TYPES)}', {}, 200),
+        'index_tag': lambda: (f'/?tags={rng.choice(tags)}', {}, 200),
+        'index_collection': lambda: (f'/?collection={rng.choice(collections)}', {}, 200),
+        'content': lambda: (rng.choice(urls), {}, 200),
+        'music_range': music_range,
+        'image': lambda: (f'/assets/{IMAGE_FILE}', {}, 200),
+        'image_resized': lambda: (f'/assets/{IMAGE_FILE}?w=640', {}, 200),
+        'rss': lambda: ('/rss', {}, 200),
+        'random': lambda: ('/random', {}, 302),
+    }
+
+def configure_environment(args, temp_dir):
+    # Local backends so importing the app doesn't connect to anything, the fakes are swapped in after
+    os.environ['CONTENT_BACKEND'] = 'local'
+    os.environ['METADATA_BACKEND'] = 'local'
+    os.environ['CONTENT_DIR'] = temp_dir
+    os.environ['METADATA_DIR'] = temp_dir
+    os.environ['IMAGE_CACHE_DIR'] = os.path.join(temp_dir, 'image_cache')
+    os.environ.setdefault('APP_SECRET_KEY', 'benchmark')
+    if args['cold']:
+        # Every request goes back to the stores, the tables built from them are rebuilt in run_worker
+        os.environ['FEED_CACHE_TTL'] = '0'
+        os.environ['MANIFEST_TTL'] = '0'
+        os.environ['RENDER_CACHE_BYTES'] = '0'
+        os.environ['IMAGE_CACHE_BYTES'] = '0'
+
+def run_worker(args, worker_id=0):
+    """Run the benchmark in this process and return its latencies, phase timings and memory"""
+    temp_dir = tempfile.mkdtemp(prefix='bench_')
+    configure_environment(args, temp_dir)
+    objects, documents, urls = build_corpus(args['entries'], seed=args['seed'])
+
+    import app as app_module
+    from utils.cache import Derived
+    from utils.metrics import metrics
+    app_module.content_store = FakeContentStore(objects, args['gcs_latency'])
+    app_module.metadata_store = FakeMetadataStore(documents, args['firestore_latency'])
+    client = app_module.app.test_client()
+    # The stores return the same data every time so the derived tables (feed index, recommendations etc)
+    # would only be built once, a cold run rebuilds them for every request
+    derived = [value for value in vars(app_module).values() if isinstance(value, Derived)] if args['cold'] else []
+
+    rng = Random(args['seed'] + worker_id)
+    routes = {
+        name: route for name, route in get_routes(rng, urls, documents).items()
+        if not args['routes'] or name in args['routes']
+    }
+
+    # One request per route first so imports and template compilation aren't measured
+    for route in routes.values():
+        path, headers, _ = route()
+        client.get(path, headers=headers).close()
+
+    schedule = [name for name in routes for _ in range(args['requests'])]
+    rng.shuffle(schedule)
+
+    latencies = {name: [] for name in routes}
+    errors = {}
+    started = perf_counter()
+    for name in schedule:
+        path, headers, expected = routes[name]()
+        for value in derived:
+            value.invalidate()
+        request_start = perf_counter()
+        response = client.get(path, headers=headers)
+        # Read the body so streamed responses are timed in full
+        response.get_data()
+        elapsed = perf_counter() - request_start
+        # Failed requests aren't timed, they'd make a broken route look fast
+        if response.status_code == expected:
+            latencies[name].append(elapsed)
+        else:
+            route_errors = errors.setdefault(name, {})
+            route_errors[response.status_code] = route_errors.get(response.status_code, 0) + 1
+        response.close()
+    elapsed = perf_counter() - started
+
+    phases = {}
+    for (name, labels), histogram in metrics.histograms.items():
+        if name == 'phase_duration_seconds':
+            phases[dict(labels)['phase']] = (histogram.sum, histogram.count)
+
+    return {
+        'latencies': latencies,
+        'errors': errors,
+        'elapsed': elapsed,
+        'phases': phases,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rss_mb': get_rss_mb(),
+    }
+
+def get_rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        return None
+
+def percentile(values, p):
+    # Nearest rank, None if nothing succeeded
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+def to_ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+def summarise(results):
+    """Combine worker results into per route throughput and percentiles in milliseconds"""
+    wall = max(result['elapsed'] for result in results)
+    routes = {}
+    for name in results[0]['latencies']:
+        values = [value for result in results for value in result['latencies'][name]]
+        statuses = {}
+        for result in results:
+            for status, count in result['errors'].get(name, {}).items():
+                statuses[str(status)] = statuses.get(str(status), 0) + count
+        routes[name] = {
+            'requests': len(values) + sum(statuses.values()),
+            'errors': sum(statuses.values()),
+            'error_statuses': statuses,
+            'throughput': len(values) / sum(values) if sum(values) else 0,
+            **{f'p{p}': to_ms(percentile(values, p)) for p in (50, 95, 99)},
+        }
+
+    phases = {}
+    for result in results:
+        for phase, (total, count) in result['phases'].items():
+            phase_total, phase_count = phases.get(phase, (0, 0))
+            phases[phase] = (phase_total + total, phase_count + count)
+
+    total_requests = sum(route['requests'] for route in routes.values())
+    return {
+        'routes': routes,
+        'throughput': total_requests / wall if wall else 0,
+        'phases': {phase: {'count': count, 'mean': total / count * 1000} for phase, (total, count) in phases.items() if count},
+        'workers': [{'rss_mb': result['rss_mb'], 'max_rss_mb': result['max_rss_mb']} for result in results],
+    }
+
+def print_summary(summary, baseline=None):
+    print(f"\n{'route':<18}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, route in summary['routes'].items():
+        timings = ''.join(f"{'-' if route[p] is None else format(route[p], '.2f'):>9}" for p in ('p50', 'p95', 'p99'))
+        line = f"{name:<18}{route['requests']:>9}{route['errors']:>8}{route['throughput']:>9.1f}{timings}"
+        if route['errors']:
+            statuses = ', '.join(f'{status} x{count}' for status, count in route['error_statuses'].items())
+            line += f"  FAILED ({statuses})"
+        elif baseline and name in baseline['routes'] and baseline['routes'][name]['p95'] is not None:
+            line += f"  p95 {change(route['p95'], baseline['routes'][name]['p95']):+.0%}"
+        print(line)
+    print(f"\nTotal throughput: {summary['throughput']:.1f} req/s")
+
+    print(f"\n{'phase':<28}{'count':>8}{'mean ms':>10}")
+    for phase, timing in sorted(summary['phases'].items()):
+        print(f"{phase:<28}{timing['count']:>8}{timing['mean']:>10.3f}")
+
+    print()
+    for i, worker in enumerate(summary['workers']):
+        rss = f"{worker['rss_mb']:.1f}" if worker['rss_mb'] is not None else '?'
+        print(f"Worker {i}: RSS {rss} MB, peak {worker['max_rss_mb']:.1f} MB")
+
+def change(value, baseline):
+    return (value - baseline) / baseline if baseline else 0
+
+def find_regressions(summary, baseline, threshold):
+    """Return the routes whose p95 is more than threshold (a fraction) slower than the baseline"""
+    return [
+        name for name, route in summary['routes'].items()
+        if name in baseline['routes'] and route['p95'] is not None and baseline['routes'][name]['p95'] is not None
+        and change(route['p95'], baseline['routes'][name]['p95']) > threshold
+    ]
+
+def find_failures(summary):
+    """Return the routes that had any response with a status other than the one expected"""
+    return [name for name, route in summary['routes'].items() if route['errors']]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the app against in-memory stores')
+    parser.add_argument('--entries', type=int, default=1000, help='Number of feed entries to generate')
+    parser.add_argument('--requests', type=int, default=100, help='Requests per route per worker')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes, each with its own copy of the app')
+    parser.add_argument('--gcs-latency', type=float, default=0.02, help='Seconds added to every content store call')
+    parser.add_argument('--firestore-latency', type=float, default=0.01, help='Seconds added to every metadata store call')
+    parser.add_argument('--cold', action='store_true', help='Disable the caches so every request reads from the stores')
+    parser.add_argument('--routes', nargs='*', help='Only benchmark these routes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare against results saved with --output')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed p95 slowdown against the baseline')
+    args = vars(parser.parse_args())
+
+    print(
+        f"Benchmarking {args['entries']} entries, {args['requests']} requests per route, {args['workers']} worker(s), "
+        f"GCS latency {args['gcs_latency'] * 1000:.0f}ms, Firestore latency {args['firestore_latency'] * 1000:.0f}ms"
+        f"{', caches disabled' if args['cold'] else ''}"
+    )
+    # Each worker imports the app itself so memory is measured per worker like gunicorn
+    with Pool(args['workers'], maxtasksperchild=1) as pool:
+        results = pool.starmap(run_worker, [(args, i) for i in range(args['workers'])])
+    summary = summarise(results)
+
+    baseline = None
+    if args['baseline']:
+        with open(args['baseline'], 'r') as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump({'args': args, **summary}, f, indent=4)
+
+    failed = False
+    failures = find_failures(summary)
+    if failures:
+        print(f"Unexpected statuses on: {', '.join(failures)}, their latencies only include the requests that succeeded")
+        failed = True
+    if baseline:
+        regressions = find_regressions(summary, baseline, args['threshold'])
+        if regressions:
+            print(f"p95 regressed by more than {args['threshold']:.0%} on: {', '.join(regressions)}")
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -1,5 +1,6 @@
 # Tagging utility for a bunch of old blog posts I scraped
 import os
+from utils.front_matter import parse_fields, split_front_matter
 
 files = os.listdir(os.path.join('STAGING', 'blogs'))
 files = [os.path.join('STAGING', 'blogs', f) for f in files]
@@ -9,11 +10,8 @@ for f in files:
     with open(f, 'r') as file_content:
         content = file_content.read()
 
-    _, metadata, content = content.split('---', 2)
-    metadata_dict = {}
-    for line in metadata.strip().split('\n'):
-        key, value = line.strip().split(': ', 1)
-        metadata_dict[key] = value
+    metadata, content = split_front_matter(content)
+    metadata_dict = parse_fields(metadata)
 
     tag_options = [
         ['Indie Game', 'Review', 'Archive'],
@@ -0,0 +1,175 @@
+# Render the site to a directory of static files for serving from a CDN or plain file server
+# Pages are rendered through the Flask app so they use the same templates and parsing
+# Each page records a hash of its inputs so a rerun only re-renders pages that changed
+#
+# This script is expected to be run from the root of the project
+# E.g. python -m content_management.export_static static_site [--full]
+import os
+import sys
+import json
+import hashlib
+from urllib.parse import urlencode
+
+from app import app, feed_index, bucket_manifest, recommendations_cache, get_collection_navigation, ITEMS_PER_PAGE
+
+EXPORT_MANIFEST = '.export_manifest.json'
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+
+def hash_inputs(*inputs):
+    """Hash anything json serialisable"""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def hash_templates():
+    # Any template change means every page is re-rendered
+    sha = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(TEMPLATE_DIR)):
+        for file in sorted(files):
+            with open(os.path.join(root, file), 'rb') as f:
+                sha.update(file.encode('utf-8'))
+                sha.update(f.read())
+    return sha.hexdigest()
+
+def get_content_pages(index, manifest, recommendations):
+    """Yield (url, output path, beacon, input hash) for every content page"""
+    for entry in index.entries:
+        location = entry['location'].lstrip('/')
+        blob = manifest.get(location)
+        if blob is None:
+            print(f"Skipping {location}, it isn't in the bucket")
+            continue
+        content_type = entry['type']
+        name = os.path.splitext(os.path.basename(location))[0]
+
+        try:
+            navigation = get_collection_navigation({'collection': entry['collection']}, location)
+        except Exception as e:
+            print(f"Could not get navigation for {location}: {e}")
+            navigation = None
+
+        yield (
+            f'/{content_type}/{name}',
+            os.path.join(content_type, f'{name}.html'),
+            f'/hits/{content_type}/{name}',
+            hash_inputs(blob.md5_hash, navigation, recommendations.get(location))
+        )
+
+def get_index_pages(index):
+    """Yield (url, output path, beacon, input hash) for every page of every filter"""
+    filters = [{}]
+    for key in ['type', 'collection', 'tags']:
+        filters.extend({key: [value]} for value in sorted(index.postings[key]) if value)
+
+    for filter_dict in filters:
+        matches = index.match(filter_dict)
+        total = len(index) if matches is None else len(matches)
+        page_count = max(1, -(-total // ITEMS_PER_PAGE))
+        for page in range(1, page_count + 1):
+            entries, _ = index.query(filter_dict, (page-1)*ITEMS_PER_PAGE, page*ITEMS_PER_PAGE)
+            args = {k: v[0] for k, v in filter_dict.items()}
+            if page > 1 or not args:
+                args['page'] = page
+            if filter_dict:
+                # e.g. _index/type=blog/page-2.html
+                key, values = next(iter(filter_dict.items()))
+                path = os.path.join('_index', f'{key}={values[0]}', f'page-{page}.html')
+            else:
+                path = 'index.html' if page == 1 else os.path.join('_index', f'page-{page}.html')
+
+            yield (
+                f'/?{urlencode(args)}',
+                path,
+                '/hits/homepage/index',
+                hash_inputs(entries, page_count)
+            )
+
+def get_misc_pages(manifest):
+    """Yield (url, output path, beacon, input hash) for the docs in the root of the bucket"""
+    for name, blob in manifest.blobs.items():
+        if '/' in name or not name.endswith('.md'):
+            continue
+        doc = name[:-3]
+        yield f'/{doc}', f'{doc}.html', f'/hits/homepage/{doc}', hash_inputs(blob.md5_hash)
+
+def get_rss_page(index):
+    # The rss route only uses the newest items
+    return '/rss', 'rss.xml', None, hash_inputs(index.entries[:ITEMS_PER_PAGE])
+
+def add_beacon(html, beacon):
+    """Add a script that registers a hit with the app when the page is viewed"""
+    script = f'<script>navigator.sendBeacon("{beacon}");</script>\n</body>'
+    return html.replace('</body>', script, 1)
+
+def load_export_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, EXPORT_MANIFEST), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def export(output_dir, full=False):
+    os.makedirs(output_dir, exist_ok=True)
+    previous = {} if full else load_export_manifest(output_dir)
+    templates_hash = hash_templates()
+
+    index = feed_index.get()
+    manifest = bucket_manifest.get()
+    recommendations = recommendations_cache.get() or {}
+
+    pages = [
+        *get_content_pages(index, manifest, recommendations),
+        *get_index_pages(index),
+        *get_misc_pages(manifest),
+        get_rss_page(index),
+    ]
+
+    # Don't count the export as views
+    app.config['COUNT_HITS'] = False
+    client = app.test_client()
+    exported = {}
+    rendered = 0
+    failed = 0
+    for url, path, beacon, input_hash in pages:
+        page_hash = hash_inputs(input_hash, templates_hash)
+        out_path = os.path.join(output_dir, path)
+        exported[path] = page_hash
+        if previous.get(path) == page_hash and os.path.exists(out_path):
+            continue
+
+        response = client.get(url)
+        if response.status_code != 200:
+            print(f"Could not render {url}: {response.status_code}")
+            failed += 1
+            # Keep the last good export, its old hash means it's tried again next time
+            if path in previous:
+                exported[path] = previous[path]
+            else:
+                exported.pop(path)
+            continue
+
+        body = response.get_data()
+        if beacon:
+            body = add_beacon(body.decode('utf-8'), beacon).encode('utf-8')
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path, 'wb') as f:
+            f.write(body)
+        rendered += 1
+        print(f"Rendered {url} to {path}")
+
+    # Remove pages whose content has gone, not ones that failed to render this time
+    for path in set(previous) - {path for _, path, _, _ in pages}:
+        try:
+            os.remove(os.path.join(output_dir, path))
+            print(f"Removed {path}")
+        except FileNotFoundError:
+            pass
+
+    with open(os.path.join(output_dir, EXPORT_MANIFEST), 'w') as f:
+        json.dump(exported, f, indent=4)
+
+    print(f"Rendered {rendered} of {len(exported)} pages to {output_dir}, {failed} failed")
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    export(args[0] if args else 'static_site', full='--full' in sys.argv)
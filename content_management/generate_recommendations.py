@@ -1,15 +1,18 @@
 import os
 import re
+import sys
 import json
-from collections import defaultdict
+import hashlib
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from sklearn.feature_extraction.text import TfidfVectorizer as TfidfVectoriser
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
 import nltk
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
 from firebase_admin import firestore, initialize_app
+from content_management.text_preprocessing import preprocess_text
 
 # global env is overwriting our local google application credentials
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "service_account.json"
@@ -23,8 +26,19 @@ nltk.download('punkt')
 nltk.download('wordnet')
 nltk.download('stopwords')
 
-lemmatizer = WordNetLemmatizer()
-stop_words = set(stopwords.words('english'))
+# Preprocessed tokens and the model from the last run, so a publish only preprocesses new or edited posts
+CACHE_FILE = ".recommendations_cache.json"
+NUM_RECS = 6
+# Preprocessing is the slow part so it's spread over every core once there's enough to do
+PREPROCESS_WORKERS = os.cpu_count() or 1
+PARALLEL_THRESHOLD = 20
+# Refit everything once this fraction of the archive has changed since the last full fit
+# Until then other posts keep their scores from when their neighbours were last worked out
+FULL_FIT_FRACTION = 0.2
+# Dense similarity blocks are kept under this many bytes
+BLOCK_BYTES = 64 * 1024 * 1024
+# Same as sklearn's default token pattern, words of two or more characters
+token_pattern = re.compile(r"(?u)\b\w\w+\b")
 
 def get_files():
     # Find the docs for vectorisation
@@ -43,62 +57,152 @@ def clean_doc_name(doc_name):
     # Remove the CONTENT/ prefix and the .md suffix
     return doc_name.replace("CONTENT/", "")
 
-def preprocess_text(text):
-    # Preprocess the text
-    # Lowercase the text
-    text = text.lower()
-    # Remove punctuation and numbers
-    text = re.sub(r'\W+', ' ', text)
-    # Tokenize the text
-    tokens = word_tokenize(text)
-    # Remove stop words and lemmatize tokens
-    tokens = [lemmatizer.lemmatize(token) for token in tokens if token not in stop_words]
-    return ' '.join(tokens)
-
-class CustomVectoriser(TfidfVectoriser):
-    def __init__(self):
-        super().__init__()
-
-    def build_preprocessor(self):
-        preprocessing_fn = super().build_preprocessor()
-        return lambda doc: preprocess_text(preprocessing_fn(doc))
-
-    def fit_transform(self, raw_documents, y=None):
-        processed_documents = [preprocess_text(doc) for doc in raw_documents.values()]
-        return super().fit_transform(processed_documents, y)
-
-    def transform(self, raw_documents):
-        processed_documents = [preprocess_text(doc) for doc in raw_documents.values()]
-        return super().transform(processed_documents)
-
-    def fit(self, raw_documents, y=None):
-        processed_documents = [preprocess_text(doc) for doc in raw_documents.values()]
-        return super().fit(processed_documents, y)
-
-
-def vectorise_docs(for_vectorisation):
-    # Vectorise the docs
-    vectoriser = CustomVectoriser()
-    vectors = vectoriser.fit_transform(for_vectorisation)
-
-    return vectors
-
-def calculate_similarity(vectors):
-    # Calculate the similarity between the vectors
-    similarity_matrix = cosine_similarity(vectors, vectors)
-    return similarity_matrix
-
-def get_recommendations(similarity_matrix, for_vectorisation, num_recs=6):
-    # Get the recommendations
-    recommendations = defaultdict(list)
-    for i, doc in enumerate(for_vectorisation):
-        print(f"Getting recommendations for {doc}")
-        recs = similarity_matrix[i].argsort()[-(1 + num_recs):-1]
-        clean_name = clean_doc_name(doc)
-        for r in recs:
-            recommendations[clean_name].append(clean_doc_name(list(for_vectorisation.keys())[r]))
-
-    return recommendations
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def count_terms(tokens):
+    return Counter(token_pattern.findall(tokens))
+
+def load_cache():
+    try:
+        with open(CACHE_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"tokens": {}, "model": None}
+
+def save_cache(cache):
+    with open(CACHE_FILE, "w") as f:
+        json.dump(cache, f)
+
+def empty_model():
+    return {"docs": {}, "df": {}, "neighbours": {}, "changes_since_full_fit": 0}
+
+def preprocess_docs(docs, token_cache):
+    # Preprocess docs whose content hash isn't in the token cache, on a process pool if there are enough
+    # Returns the hash of every doc
+    hashes = {}
+    missing = {}
+    for doc, text in docs.items():
+        text_hash = hash_text(text)
+        if text_hash not in token_cache:
+            missing[text_hash] = text
+        hashes[clean_doc_name(doc)] = text_hash
+
+    if missing:
+        started = perf_counter()
+        texts = list(missing.values())
+        if len(texts) >= PARALLEL_THRESHOLD:
+            with ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS) as executor:
+                chunksize = max(1, len(texts) // (PREPROCESS_WORKERS * 4))
+                tokens = list(executor.map(preprocess_text, texts, chunksize=chunksize))
+        else:
+            tokens = [preprocess_text(text) for text in texts]
+        token_cache.update(zip(missing, tokens))
+        elapsed = perf_counter() - started
+        print(f"Preprocessed {len(texts)} docs in {elapsed:.1f}s, {len(texts) / elapsed:.1f} docs/s")
+    return hashes
+
+def update_document_frequencies(df, previous, hashes, token_cache):
+    # Take the terms of edited and removed docs out of the document frequencies and add the new ones
+    # Returns the names of new and edited docs
+    changed = []
+    for name, text_hash in previous.items():
+        if hashes.get(name) != text_hash:
+            df.subtract(set(count_terms(token_cache[text_hash])))
+    for name, text_hash in hashes.items():
+        if previous.get(name) != text_hash:
+            df.update(set(count_terms(token_cache[text_hash])))
+            changed.append(name)
+    # Drop terms that aren't in any doc any more
+    for term in [term for term, count in df.items() if count <= 0]:
+        del df[term]
+    return changed
+
+def vectorise_docs(names, hashes, token_cache, df):
+    # Build the tf-idf matrix from the cached tokens and document frequencies
+    # Uses sklearn's smoothed idf and l2 normalised rows so a dot product is the cosine similarity
+    # Single precision halves the memory of the similarity blocks
+    terms = sorted(df)
+    vocabulary = {term: i for i, term in enumerate(terms)}
+    idf = np.log((1 + len(names)) / (1 + np.array([df[term] for term in terms], dtype=float))) + 1
+
+    rows, cols, values = [], [], []
+    for i, name in enumerate(names):
+        for term, count in count_terms(token_cache[hashes[name]]).items():
+            rows.append(i)
+            cols.append(vocabulary[term])
+            values.append(count * idf[vocabulary[term]])
+
+    vectors = csr_matrix((values, (rows, cols)), shape=(len(names), len(vocabulary)))
+    return normalize(vectors).astype(np.float32)
+
+def similarity_blocks(rows, columns):
+    # Yield (first row, dense similarities) for blocks of rows against every column
+    # Blocks are sized so the dense part stays under BLOCK_BYTES however big the archive gets
+    block_size = max(1, BLOCK_BYTES // (4 * max(1, columns.shape[0])))
+    columns = columns.T.tocsr()
+    for start in range(0, rows.shape[0], block_size):
+        yield start, (rows[start:start + block_size] @ columns).toarray()
+
+def top_k(similarities, own_columns, num_recs=NUM_RECS):
+    # Column indices and scores of the best num_recs in each row, best first
+    # own_columns is the column of each row's own doc, or -1, which is never picked
+    rows = np.flatnonzero(own_columns >= 0)
+    similarities[rows, own_columns[rows]] = -np.inf
+    k = min(num_recs, similarities.shape[1])
+    if k < similarities.shape[1]:
+        best = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        best = np.tile(np.arange(k), (similarities.shape[0], 1))
+    scores = np.take_along_axis(similarities, best, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+def to_recs(indices, scores, names):
+    # [name, score] pairs, leaving out a doc's own entry
+    return [[names[j], float(score)] for j, score in zip(indices, scores) if score != -np.inf]
+
+def calculate_neighbours(vectors, names, rows=None):
+    # Work out the neighbours of the docs at the row indices, or every doc, a block at a time
+    rows = np.arange(len(names)) if rows is None else np.asarray(rows, dtype=int)
+    neighbours = {}
+    for start, similarities in similarity_blocks(vectors[rows], vectors):
+        block_rows = rows[start:start + similarities.shape[0]]
+        best, scores = top_k(similarities, block_rows)
+        for row, indices, row_scores in zip(block_rows, best, scores):
+            neighbours[names[row]] = to_recs(indices, row_scores, names)
+    return neighbours
+
+def update_neighbours(vectors, names, neighbours, changed, num_recs=NUM_RECS):
+    # Work out the neighbours of new and edited docs and of any doc whose list has one that changed or went
+    # Everyone else only needs to check whether a new or edited doc is now one of their best matches
+    index = {name: i for i, name in enumerate(names)}
+    changed = set(changed)
+    affected = changed | {
+        name for name, recs in neighbours.items()
+        if name in index and any(rec not in index or rec in changed for rec, _ in recs)
+    }
+    neighbours = {name: recs for name, recs in neighbours.items() if name in index and name not in affected}
+
+    if changed:
+        changed = sorted(changed)
+        unaffected = sorted(neighbours)
+        rows = np.array([index[name] for name in unaffected], dtype=int)
+        columns = vectors[[index[name] for name in changed]]
+        for start, similarities in similarity_blocks(vectors[rows], columns):
+            # None of these rows are in the changed columns
+            best, scores = top_k(similarities, np.full(similarities.shape[0], -1), num_recs)
+            for name, indices, row_scores in zip(unaffected[start:], best, scores):
+                candidates = to_recs(indices, row_scores, changed)
+                neighbours[name] = sorted(neighbours[name] + candidates, key=lambda rec: rec[1], reverse=True)[:num_recs]
+
+    neighbours.update(calculate_neighbours(vectors, names, sorted(index[name] for name in affected)))
+    print(f"Updated the neighbours of {len(affected)} docs in full")
+    return neighbours
+
+def get_recommendations(neighbours):
+    # The recommendations document only needs the names
+    return {name: [rec for rec, _ in recs] for name, recs in neighbours.items()}
 
 def update_firestore(recommendations):
     try:
@@ -108,16 +212,44 @@ def update_firestore(recommendations):
     except Exception as e:
         print(f"Error updating Firestore: {e}")
 
-def main():
+def main(full=False):
     # This script is expected to be run from the root of the project
-    # E.g. python content_management/generate_recommendations.py
+    # E.g. python -m content_management.generate_recommendations [--full]
     for_vectorisation = get_files()
+    cache = load_cache()
+    token_cache = cache["tokens"]
+    model = cache["model"] or empty_model()
+
+    hashes = preprocess_docs(for_vectorisation, token_cache)
+    names = sorted(hashes)
+
+    df = Counter(model["df"])
+    changed = update_document_frequencies(df, model["docs"], hashes, token_cache)
+    removed = [name for name in model["docs"] if name not in hashes]
+    print(f"{len(changed)} new or edited docs, {len(removed)} removed")
+
+    vectors = vectorise_docs(names, hashes, token_cache, df)
 
-    X = vectorise_docs(for_vectorisation)
+    changes_since_full_fit = model["changes_since_full_fit"] + len(changed) + len(removed)
+    if full or not model["neighbours"] or changes_since_full_fit > FULL_FIT_FRACTION * len(names):
+        print("Working out every doc's neighbours")
+        neighbours = calculate_neighbours(vectors, names)
+        changes_since_full_fit = 0
+    else:
+        neighbours = update_neighbours(vectors, names, model["neighbours"], changed)
 
-    similarity_matrix = calculate_similarity(X)
+    # Only keep tokens for content that's still around
+    used = set(hashes.values())
+    cache["tokens"] = {text_hash: tokens for text_hash, tokens in token_cache.items() if text_hash in used}
+    cache["model"] = {
+        "docs": hashes,
+        "df": dict(df),
+        "neighbours": neighbours,
+        "changes_since_full_fit": changes_since_full_fit,
+    }
+    save_cache(cache)
 
-    recommendations = get_recommendations(similarity_matrix, for_vectorisation)
+    recommendations = get_recommendations(neighbours)
 
     # Now output to a file
     with open('recommendations.json', 'w') as f:
@@ -129,4 +261,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    main(full="--full" in sys.argv)
@@ -0,0 +1,34 @@
+# Text preprocessing for the recommendations
+# This is kept apart from generate_recommendations so process pool workers can import it
+# without connecting to Firestore or downloading the NLTK data again
+import re
+from functools import lru_cache
+
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize import word_tokenize
+
+lemmatizer = WordNetLemmatizer()
+
+@lru_cache(maxsize=None)
+def get_stop_words():
+    # Loaded on first use so the NLTK data can be downloaded first
+    return set(stopwords.words('english'))
+
+@lru_cache(maxsize=None)
+def lemmatize(token):
+    # There are far fewer distinct words than tokens so each word is only looked up once per process
+    return lemmatizer.lemmatize(token)
+
+def preprocess_text(text):
+    # Preprocess the text
+    # Lowercase the text
+    text = text.lower()
+    # Remove punctuation and numbers
+    text = re.sub(r'\W+', ' ', text)
+    # Tokenize the text
+    tokens = word_tokenize(text)
+    # Remove stop words and lemmatize tokens
+    stop_words = get_stop_words()
+    tokens = [lemmatize(token) for token in tokens if token not in stop_words]
+    return ' '.join(tokens)
@@ -1,7 +1,27 @@
 # Gets all staging images and creates thumbnails for them if they don't already exist
+# Also makes the smaller sizes and formats of each image that pages ask for with ?w= and fmt=
 
 import os
+import sys
+import json
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
+from utils.image_utils import image_variants, variant_name, display_size
+from utils.hashing import file_md5_base64
+
+# Should be some of the widths the app snaps requests to (IMAGE_WIDTHS in app.py) or they'll never be used
+VARIANT_WIDTHS = [320, 640, 960, 1280]
+VARIANT_FORMATS = ['jpeg', 'webp']
+VARIANT_QUALITY = 80
+# Variants go straight into CONTENT like the pre-rendered docs, under images/variants/ in the bucket
+VARIANT_DIR = os.path.join('CONTENT', 'images', 'variants')
+# Remembers what was made from each image so unchanged images are skipped next time
+# The dot keeps it out of the local content store's listing
+MANIFEST_NAME = '.variants.json'
+VARIANT_WORKERS = os.cpu_count() or 1
+# Only images pages can ask to resize
+VARIANT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
 
 def generate_thumbnail(img):
     path, filename = os.path.split(img)
@@ -20,7 +40,101 @@ def generate_thumbnail(img):
 
     print(f'Created thumbnail for {filename}')
 
+def load_manifest(output_dir=VARIANT_DIR):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest, output_dir=VARIANT_DIR):
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+def is_current(entry, md5_hash, config, output_dir):
+    # Same image, same settings and nobody has deleted the files
+    return (
+        entry is not None
+        and entry['md5'] == md5_hash
+        and entry['config'] == config
+        and all(os.path.exists(os.path.join(output_dir, v['file'])) for v in entry['variants'])
+    )
+
+def generate_variants(img, md5_hash, config, output_dir=VARIANT_DIR):
+    # Write every variant of one image, returns its manifest entry
+    # Runs in a worker process so it only gets paths and settings
+    with open(img, 'rb') as f:
+        data = f.read()
+
+    with Image.open(img) as im:
+        width, height = display_size(im)
+
+    variants = []
+    for variant_width, variant_height, fmt, variant in image_variants(data, config['widths'], config['formats'], config['quality']):
+        name = variant_name(img, md5_hash, variant_width, fmt).split('/')[-1]
+        with open(os.path.join(output_dir, name), 'wb') as f:
+            f.write(variant)
+        variants.append({'file': name, 'width': variant_width, 'height': variant_height, 'format': fmt, 'bytes': len(variant)})
+
+    return {'md5': md5_hash, 'config': config, 'width': width, 'height': height, 'variants': variants}
+
+def generate_all_variants(imgs, widths=VARIANT_WIDTHS, formats=VARIANT_FORMATS, quality=VARIANT_QUALITY,
+                          output_dir=VARIANT_DIR, workers=VARIANT_WORKERS):
+    # Make the variants of every image that has changed since the last run on a process pool
+    # Returns the paths of the variants of all the images, made now or before
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    config = {'widths': sorted(widths), 'formats': list(formats), 'quality': quality}
+
+    todo = {}
+    for img in dict.fromkeys(imgs):
+        if not img.lower().endswith(VARIANT_EXTENSIONS) or not os.path.exists(img):
+            continue
+        # Base64 like GCS reports it, the app works out the variant names from the bucket's hash
+        md5_hash = file_md5_base64(img)
+        if is_current(manifest.get(os.path.basename(img)), md5_hash, config, output_dir):
+            print(f'Variants already exist for {img}')
+        else:
+            todo[img] = md5_hash
+
+    started = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            img: executor.submit(generate_variants, img, md5_hash, config, output_dir)
+            for img, md5_hash in todo.items()
+        }
+        for img, future in futures.items():
+            try:
+                entry = future.result()
+            except Exception as e:
+                print(f'Could not make variants of {img}: {e}')
+                continue
+            # Clear out the variants of the image's old version
+            old = manifest.get(os.path.basename(img), {'variants': []})
+            for v in old['variants']:
+                if v['file'] not in {new['file'] for new in entry['variants']}:
+                    try:
+                        os.remove(os.path.join(output_dir, v['file']))
+                    except FileNotFoundError:
+                        pass
+            manifest[os.path.basename(img)] = entry
+            print(f'Created {len(manifest[os.path.basename(img)]["variants"])} variants of {img}')
+    save_manifest(manifest, output_dir)
+
+    if todo:
+        elapsed = perf_counter() - started
+        print(f'Made variants of {len(todo)} images in {elapsed:.1f}s, {len(todo) / elapsed:.1f} images/s')
+
+    return [
+        os.path.join(output_dir, v['file'])
+        for img in dict.fromkeys(imgs) if os.path.basename(img) in manifest
+        for v in manifest[os.path.basename(img)]['variants']
+    ]
+
 if __name__ == "__main__":
+    # E.g. python -m content_management.thumbnailify [--variants]
     imgs = [os.path.join('STAGING', 'images', f) for f in os.listdir('STAGING/images')]
     for img in imgs:
         generate_thumbnail(img)
+    if '--variants' in sys.argv:
+        generate_all_variants([img for img in imgs if not img.endswith('_thumbnail.jpg')])
@@ -1,7 +1,10 @@
 # Update the metadata for all the content in the content log
-import os
+# Entries remember the generation of the object they were read from so unchanged content is skipped
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.cloud import storage
 from firebase_admin import firestore, initialize_app
+from utils.front_matter import parse_metadata, read_front_matter
 
 # Establish a connection to the Google Cloud Storage and Firestore
 storage_client = storage.Client()
@@ -9,62 +12,78 @@ bucket = storage_client.bucket('website-content12345')
 initialize_app()
 db = firestore.client()
 
+# Number of posts read at once
+WORKERS = 16
+
 def get_content_log():
     global db
     content_log_ref = db.collection('feed').document('content-log')
     return content_log_ref
 
 def get_metadata(blob_path):
-    blob = bucket.blob(blob_path)
-    md = blob.download_as_string().decode('utf-8')
-    # We can capture the section between --- and --- and use it as metadata
-    metadata = md.split('---')[1]
-
-    # Parse the metadata section of the markdown file and return a dictionary
-    metadata_dict = {}
-    for line in metadata.split('\n'):
-        if line:
-            split_line = line.split(':')
-            key = split_line[0].strip()
-            # Remove the quotes
-            value = ":".join(split_line[1:]).strip()
-            metadata_dict[key.strip()] = value
-
-    # Add a key for filename for linking
-    metadata_dict['filename'] = blob_path.split('/')[-1].split('.')[0]
-    try:
-        metadata_dict['url'] = os.path.join(metadata_dict['type'], metadata_dict['filename'])
-    except:
-        print(f"Error parsing metadata for {blob}")
+    # Locations in the content log have a leading slash, object names don't
+    blob = bucket.blob(blob_path.lstrip('/'))
+    # Only the head of the file is downloaded, not the whole post
+    metadata = read_front_matter(blob)
+    return parse_metadata(metadata, blob_path)
 
-    return metadata_dict
+def get_generations():
+    # One listing gives the generation of every object instead of a request per object
+    blobs = bucket.list_blobs(fields='items(name,generation),nextPageToken')
+    return {blob.name: blob.generation for blob in blobs}
 
-def update_metadata():
+def update_metadata(full=False, workers=WORKERS):
     global bucket
     try:
         # So we get the content log
         content_log = get_content_log()
         content_log_data = content_log.get().to_dict()
+        generations = get_generations()
+
+        # Only fetch entries whose object has been uploaded since their metadata was read
+        stale = {}
+        for key, v in content_log_data.items():
+            generation = generations.get(v['location'].lstrip('/'))
+            if generation is None:
+                print(f"{v['location']} isn't in the bucket, skipping it")
+            elif full or v.get('generation') != generation:
+                stale[key] = generation
+
+        print(f"{len(stale)} of {len(content_log_data)} entries have changed")
 
-        for v in content_log_data.values():
-            # Get the metadata for the blob
-            blob_path = v['location']
-            metadata = get_metadata(blob_path)
+        changed = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(get_metadata, content_log_data[key]['location']): key
+                for key in stale
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                v = content_log_data[key]
+                try:
+                    metadata = future.result()
+                except Exception as e:
+                    print(f"Could not get metadata for {v['location']}: {e}")
+                    continue
 
-            # Now update v
-            v.update(metadata)
+                # Now update v
+                v.update(metadata)
+                v['generation'] = stale[key]
+                changed[key] = v
 
-            print('Got metadata for', blob_path)
+                print('Got metadata for', v['location'])
 
-        # Write it back
-        content_log.set(content_log_data)
+        # Write back only the entries that changed, merge leaves the rest of the log alone
+        if changed:
+            content_log.set(changed, merge=True)
         return True
     except Exception as e:
         return str(e)
 
 if __name__ == '__main__':
-    res = update_metadata()
-    if res:
+    # E.g. python -m content_management.update_metadata [--full]
+    res = update_metadata(full='--full' in sys.argv)
+    if res is True:
         print('Metadata updated successfully')
     else:
         print(res)
@@ -1,11 +1,20 @@
 import os
 import re
-import subprocess
+import json
+import hashlib
+import mimetypes
+from time import perf_counter
 from shutil import copy
 from datetime import datetime as dt
-from content_management.thumbnailify import generate_thumbnail
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import google_crc32c
+from google.cloud import storage
+from content_management.thumbnailify import generate_thumbnail, generate_all_variants
 from content_management.generate_recommendations import main as generate_recommendations
 from utils.string_utils import strip_punctuation
+from utils.rendering import build_artifact, artifact_name
+from utils.hashing import md5_base64, hash_file, to_base64
+from utils.front_matter import parse_fields, split_front_matter
 from firebase_admin import firestore, initialize_app
 
 # global env is overwriting our local google application credentials
@@ -16,6 +25,13 @@ try:
 except:
     pass
 db = firestore.client()
+# One client shared by all the upload threads
+bucket = storage.Client().bucket("website-content54321")
+
+UPLOAD_WORKERS = 8
+# Bigger files (mostly music) are sent as resumable uploads in chunks so a dropped connection doesn't start again
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
 
 # Compile re patterns - these capture the relative path to the media
 img_pattern = re.compile(r"/assets/(images/[\S]+)")
@@ -40,13 +56,8 @@ def parse_markdown(docs):
     for doc in docs:
         with open(doc, 'r') as f:
             doc_content = f.read()
-        _, metadata, content = doc_content.split("---", 2)
-
-        metadata_dict = {}
-        for line in metadata.split("\n"):
-            if line:
-                key, value = line.split(":", 1)
-                metadata_dict[key] = value.strip()
+        metadata, _ = split_front_matter(doc_content)
+        metadata_dict = parse_fields(metadata)
 
         # Get the related media
         related_media = get_related_media(doc_content)
@@ -85,15 +96,111 @@ def generate_thumbnails(doc_metadata):
             # Generate the thumbnail
             generate_thumbnail(base_image)
 
-def upload_content(content):
-    cwd = os.getcwd()
-    for doc in content:
-        # Move the file to the content bucket
-        # Truncate the path
-        doc = doc.replace(cwd, "")
-        # Get the subdirectory
-        subdirectory = doc.split("/")[1]
-        subprocess.run(["gsutil", "cp", doc, f"gs://website-content54321/{subdirectory}"])
+def generate_image_variants(doc_metadata):
+    # Make the smaller sizes and formats of the images in the docs, thumbnails are small enough already
+    images = [
+        os.path.join("STAGING", media)
+        for metadata in doc_metadata.values() for media in metadata["related_media"]
+        if media.startswith("images/") and not media.endswith("_thumbnail.jpg")
+    ]
+    return generate_all_variants(images)
+
+def render_artifacts(docs, doc_metadata):
+    # Render the markdown now so the app doesn't have to render it on each request
+    # The artifacts go straight into CONTENT next to where the docs are copied
+    artifacts = []
+    for doc in docs:
+        with open(doc, 'rb') as f:
+            data = f.read()
+        blob_name = os.path.relpath(doc, "STAGING")
+        # Music pages are rendered with their track listing
+        kinds = ["markdown"]
+        if doc_metadata[doc].get("type") == "music":
+            kinds.append("music")
+        try:
+            artifact = build_artifact(data.decode('utf-8'), blob_name, md5_base64(data), kinds)
+        except Exception as e:
+            print(f"Could not pre-render {doc}, it will be rendered by the app: {e}")
+            continue
+
+        artifact_path = os.path.join("CONTENT", artifact_name(blob_name))
+        os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+        with open(artifact_path, 'w') as f:
+            json.dump(artifact, f)
+        artifacts.append(artifact_path)
+        print(f"Pre-rendered {doc} to {artifact_path}")
+
+    return artifacts
+
+def get_object_name(path):
+    # STAGING/blogs/post.md and CONTENT/blogs/post.md.json are uploaded to blogs/...
+    return os.path.relpath(path).split(os.sep, 1)[1].replace(os.sep, "/")
+
+def get_remote_hashes():
+    # One listing gets the hashes of everything in the bucket
+    blobs = bucket.list_blobs(fields="items(name,md5Hash,crc32c),nextPageToken")
+    return {blob.name: (blob.md5_hash, blob.crc32c) for blob in blobs}
+
+def get_file_hashes(path):
+    # Base64 MD5 and CRC32C like GCS reports them
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    hash_file(path, md5, crc32c)
+    return to_base64(md5.digest()), to_base64(crc32c.digest())
+
+def is_unchanged(path, remote_hashes):
+    if remote_hashes is None:
+        return False
+    md5, crc32c = get_file_hashes(path)
+    remote_md5, remote_crc32c = remote_hashes
+    # Composite objects don't have an MD5 so compare the CRC32C instead
+    if remote_md5:
+        return remote_md5 == md5
+    return remote_crc32c == crc32c
+
+def upload_file(path, remote_hashes):
+    # Returns the bytes uploaded or None if the file was skipped
+    name = get_object_name(path)
+    if is_unchanged(path, remote_hashes):
+        print(f"Skipped {path}, it's the same as gs://{bucket.name}/{name}")
+        return None
+
+    size = os.path.getsize(path)
+    blob = bucket.blob(name)
+    if size > RESUMABLE_THRESHOLD:
+        blob.chunk_size = CHUNK_SIZE
+    blob.upload_from_filename(path, content_type=mimetypes.guess_type(path)[0])
+    print(f"Uploaded {path} to gs://{bucket.name}/{name}")
+    return size
+
+def upload_files(paths, remote_hashes, stats):
+    # Upload on a thread pool, adding the counts and bytes to stats
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(upload_file, path, remote_hashes.get(get_object_name(path))): path
+            # The same media can be linked more than once
+            for path in dict.fromkeys(paths)
+        }
+        for future in as_completed(futures):
+            try:
+                size = future.result()
+            except Exception as e:
+                print(f"Could not upload {futures[future]}: {e}")
+                stats["failed"] += 1
+                continue
+            if size is None:
+                stats["skipped"] += 1
+            else:
+                stats["uploaded"] += 1
+                stats["bytes"] += size
+
+def print_upload_summary(stats, elapsed):
+    megabytes = stats["bytes"] / 1024 / 1024
+    print(
+        f"Uploaded {stats['uploaded']} files ({megabytes:.1f}MB) in {elapsed:.1f}s, "
+        f"{megabytes / elapsed if elapsed else 0:.1f}MB/s. "
+        f"Skipped {stats['skipped']} unchanged files, {stats['failed']} failed"
+    )
 
 def update_firestore(docs_metadata):
     feed_ref = db.collection('feed').document('content-log')
@@ -178,15 +285,24 @@ if __name__ == "__main__":
 
     print("Generated thumbnails")
 
-    # Upload docs to the content bucket
-    upload_content(content)
+    variants = generate_image_variants(doc_metadata)
 
-    # Upload images to the content bucket
-    for metadata in doc_metadata.values():
-        related_media = metadata["related_media"]
-        for media in related_media:
-            media_type = media.split("/")[0]
-            subprocess.run(["gsutil", "cp", os.path.join("STAGING", media), f"gs://website-content54321/{media_type}"])
+    artifacts = render_artifacts(content, doc_metadata)
+
+    upload_started = perf_counter()
+    upload_stats = {"uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    remote_hashes = get_remote_hashes()
+
+    # Upload images and music to the content bucket first so the docs never link to missing media
+    media = [
+        os.path.join("STAGING", media)
+        for metadata in doc_metadata.values() for media in metadata["related_media"]
+    ]
+    upload_files(media + variants, remote_hashes, upload_stats)
+
+    # Then the docs, the app checks the artifacts against the docs' hashes so they can go up together
+    upload_files(content + artifacts, remote_hashes, upload_stats)
+    upload_elapsed = perf_counter() - upload_started
 
     # Update the firestore docs
     update_firestore(doc_metadata)
@@ -201,3 +317,4 @@ if __name__ == "__main__":
     cleanup_files(doc_metadata)
 
     print("Finished updating the site")
+    print_upload_summary(upload_stats, upload_elapsed)
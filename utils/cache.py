@@ -0,0 +1,115 @@
+"""In-process caches for remote data
+SnapshotCache keeps one copy of a remote value (e.g. a Firestore document) per worker.
+It reloads after a TTL, or sooner if a change listener pushes a new copy.
+Derived builds a value from one or more caches and only rebuilds it when they change.
+"""
+
+import os
+import time
+import logging
+from threading import RLock
+
+
+class SnapshotCache:
+    def __init__(self, loader, ttl=300, watch=None):
+        """loader returns a fresh copy of the data
+        watch is optional: it is called with an on_change callback and should start a
+        listener that calls it with new data, returning something with unsubscribe()"""
+        self.loader = loader
+        self.ttl = ttl
+        self.watch = watch
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = None
+        self._loaded_at = None
+        self._stale = True
+        self._lock = RLock()
+        self._watcher = None
+        self._watcher_pid = None
+
+    def get(self):
+        """Return the cached data, reloading it if it has expired"""
+        return self.snapshot()[0]
+
+    def snapshot(self):
+        """Return the cached data and its version together"""
+        self._ensure_watcher()
+        if self._expired():
+            with self._lock:
+                if self._expired():
+                    self.misses += 1
+                    self.refresh()
+                    return self._data, self.version
+        self.hits += 1
+        return self._data, self.version
+
+    def refresh(self):
+        """Reload the data from the source"""
+        self.set(self.loader())
+
+    def set(self, data):
+        """Replace the cached data, bumping the version if it actually changed"""
+        with self._lock:
+            if self.version == 0 or data != self._data:
+                self._data = data
+                self.version += 1
+            self._loaded_at = time.monotonic()
+            self._stale = False
+
+    def invalidate(self):
+        """Force a reload on the next read"""
+        self._stale = True
+
+    def _expired(self):
+        return self._stale or time.monotonic() - self._loaded_at > self.ttl
+
+    def _ensure_watcher(self):
+        # Listeners run on background threads so they have to be started after a fork
+        if self.watch is None or self._watcher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+            try:
+                self._watcher = self.watch(self.set)
+            except Exception as e:
+                # Fall back to polling on the TTL
+                logging.error(f"Could not start cache listener: {e}")
+                self._watcher = None
+
+    def close(self):
+        """Stop the change listener if there is one"""
+        if self._watcher is not None:
+            try:
+                self._watcher.unsubscribe()
+            except Exception as e:
+                logging.error(e)
+            self._watcher = None
+
+
+class Derived:
+    def __init__(self, builder, *sources):
+        """builder is called with the data from each source cache
+        The result is kept until any of the sources changes version"""
+        self.builder = builder
+        self.sources = sources
+        self._value = None
+        self._versions = None
+        self._lock = RLock()
+
+    def get(self):
+        snapshots = [source.snapshot() for source in self.sources]
+        versions = tuple(version for _, version in snapshots)
+        if versions != self._versions:
+            with self._lock:
+                if versions != self._versions:
+                    self._value = self.builder(*[data for data, _ in snapshots])
+                    self._versions = versions
+        return self._value
+
+    def invalidate(self):
+        """Force a rebuild on the next read"""
+        with self._lock:
+            self._versions = None
@@ -0,0 +1,100 @@
+"""Size-capped local disk cache
+Files are stored under a hash of their key and evicted least recently used first.
+Several worker processes can share a directory, writes are atomic renames.
+"""
+
+import os
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.bytes = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Return the path of a cached file or None"""
+        path = self._path(key)
+        try:
+            # Bump the modified time, it's what eviction goes on
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, data):
+        """Write bytes to the cache and return the path
+        Returns None without caching anything bigger than the eviction target"""
+        if len(data) > self.max_bytes * 0.9:
+            return None
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.bytes += len(data)
+            if self.bytes > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _scan(self):
+        """Return (path, size, mtime) for every cached file"""
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+            except FileNotFoundError:
+                # Another worker evicted it
+                continue
+        return files
+
+    def _evict(self, keep=None):
+        # Rescan as other workers share the directory, then drop the oldest files
+        # until we're back under 90% of the budget
+        # keep is the file just written, the caller is about to send it
+        files = sorted(self._scan(), key=lambda f: f[2])
+        self.bytes = sum(size for _, size, _ in files)
+        target = self.max_bytes * 0.9
+        for path, size, _ in files:
+            if self.bytes <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(e)
+                continue
+            self.bytes -= size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,91 @@
+"""Feed index
+Sorts the feed once and builds postings (value -> positions) for the filterable fields.
+A filtered page of the feed then costs the number of matches rather than the size of the feed.
+"""
+
+import heapq
+
+from utils.string_utils import clean_tags, clean_collection_name
+
+
+class FeedIndex:
+    def __init__(self, data):
+        """data is the content-log document, keyed by timestamp"""
+        # Sort by key (timestamp) desc
+        # Order is not guaranteed in Firestore so we need to sort it here
+        items = sorted(data.items(), key=lambda item: item[0], reverse=True)
+        self.raw = [v for _, v in items]
+        self.entries = [self._prepare_entry(date, v) for date, v in items]
+
+        # Postings for the filters the index page uses, anything else is built on demand
+        self.postings = {
+            'tags': self._build_postings(lambda entry: entry.get('tags', [])),
+            'collection': self._build_postings(lambda entry: [entry['clean_collection']]),
+            'type': self._build_postings(lambda entry: [entry.get('type')]),
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _prepare_entry(date, v):
+        """Copy a feed item and precompute the fields the templates need"""
+        entry = dict(v)
+        if 'tags' in entry:
+            entry['tags'] = clean_tags(entry['tags'])
+        entry['clean_collection'] = clean_collection_name(entry.get('collection', ''))
+        entry['date'] = date
+        return entry
+
+    def _build_postings(self, get_values):
+        postings = {}
+        for position, entry in enumerate(self.entries):
+            for value in get_values(entry):
+                positions = postings.setdefault(value, [])
+                # An entry can list the same tag twice
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+        return postings
+
+    def _get_postings(self, key):
+        if key not in self.postings:
+            # Other metadata keys match on the raw value
+            postings = {}
+            for position, v in enumerate(self.raw):
+                if key in v:
+                    postings.setdefault(v[key], []).append(position)
+            self.postings[key] = postings
+        return self.postings[key]
+
+    def match(self, filters):
+        """Return the sorted positions of entries passing the filters, or None for no filters
+        Filters is a dictionary of metadata keys to a list of accepted values
+        An entry passes if it matches at least one value for every key"""
+        if len(filters) == 1:
+            # Postings are already in feed order so a single filter needs no sorting
+            # With one value (the usual case) it's the posting list itself, which mustn't be changed
+            key, values = next(iter(filters.items()))
+            postings = self._get_postings(key)
+            lists = [postings[value] for value in dict.fromkeys(values) if value in postings]
+            if len(lists) == 1:
+                return lists[0]
+            return list(dict.fromkeys(heapq.merge(*lists)))
+
+        matches = None
+        for key, values in filters.items():
+            postings = self._get_postings(key)
+            positions = set()
+            for value in values:
+                positions.update(postings.get(value, ()))
+            matches = positions if matches is None else matches & positions
+            if not matches:
+                return []
+        return None if matches is None else sorted(matches)
+
+    def query(self, filters, start, end):
+        """Return the entries between start and end that pass the filters and the total matched"""
+        start, end = max(start, 0), max(end, 0)
+        matches = self.match(filters)
+        if matches is None:
+            return self.entries[start:end], len(self.entries)
+        return [self.entries[i] for i in matches[start:end]], len(matches)
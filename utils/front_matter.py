@@ -0,0 +1,54 @@
+"""Front matter parsing
+Content markdown starts with a metadata block between --- lines, then the body and, for music,
+a track listing after another ---. Everything that reads content parses it with these, and
+read_front_matter only downloads the head of a blob for anything that just needs the metadata.
+"""
+
+import os
+
+SEPARATOR = '---'
+# Enough for the metadata of any post, more is fetched if the block doesn't end in it
+HEAD_BYTES = 4096
+
+
+def parse_fields(text):
+    """Parse key: value lines into a dictionary, values may contain colons"""
+    fields = {}
+    for line in text.split('\n'):
+        if line:
+            key, _, value = line.partition(':')
+            fields[key.strip()] = value.strip()
+    return fields
+
+def split_sections(md):
+    """Split a document into the text before the metadata, the metadata, the body and any later sections"""
+    return md.split(SEPARATOR)
+
+def split_front_matter(md):
+    """Return the metadata block and everything after it"""
+    _, metadata, content = md.split(SEPARATOR, 2)
+    return metadata, content
+
+def parse_metadata(metadata, blob_name):
+    """Parse the metadata section of a markdown file and return a dictionary"""
+    metadata_dict = parse_fields(metadata)
+
+    # Add a key for filename for linking
+    metadata_dict['filename'] = blob_name.split('/')[-1].split('.')[0]
+    try:
+        metadata_dict['url'] = os.path.join(metadata_dict['type'], metadata_dict['filename'])
+    except:
+        print(f"Error parsing metadata for {blob_name}")
+
+    return metadata_dict
+
+def read_front_matter(blob, head_bytes=HEAD_BYTES):
+    """Return the metadata block of a markdown blob, downloading as little of it as possible
+    Starts with a ranged read of the first head_bytes and doubles it until the block is closed"""
+    while True:
+        data = blob.download_as_bytes(start=0, end=head_bytes - 1)
+        # The range can cut a character in half but only after the metadata
+        text = data.decode('utf-8', errors='ignore')
+        if text.count(SEPARATOR) >= 2 or len(data) < head_bytes:
+            return split_front_matter(text)[0]
+        head_bytes *= 2
@@ -0,0 +1,31 @@
+"""Content hashes in the form GCS reports them
+The app, the local content store and the publish scripts all compare files by their base64 MD5."""
+
+import base64
+import hashlib
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def to_base64(digest):
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def md5_base64(data):
+    """MD5 of some bytes in the base64 form GCS reports"""
+    return to_base64(hashlib.md5(data).digest())
+
+
+def hash_file(path, *hashes):
+    """Update each hash object with a file's contents, read a chunk at a time"""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            for h in hashes:
+                h.update(chunk)
+
+
+def file_md5_base64(path):
+    """MD5 of a file in the base64 form GCS reports"""
+    md5 = hashlib.md5()
+    hash_file(path, md5)
+    return to_base64(md5.digest())
@@ -0,0 +1,67 @@
+"""Write-behind hit counter
+Hits are aggregated in memory and flushed as batched deltas on a background thread,
+so requests never wait on analytics writes.
+"""
+
+import os
+import atexit
+import logging
+from collections import Counter
+from threading import Lock, Thread, Event
+
+
+class HitCounter:
+    def __init__(self, flush, interval=30):
+        """flush is called with a dict of {key: delta} and should write it to the backend
+        interval is the number of seconds between flushes"""
+        self._flush = flush
+        self.interval = interval
+        self._pending = Counter()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def record(self, key, count=1):
+        """Count a hit, it will be written on the next flush"""
+        self._ensure_thread()
+        with self._lock:
+            self._pending[key] += count
+
+    def flush(self):
+        """Write any pending hits to the backend"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return
+        try:
+            self._flush(dict(pending))
+        except Exception as e:
+            logging.error(f"Could not flush hit counter: {e}")
+            # Put them back so they go out with the next flush
+            with self._lock:
+                self._pending.update(pending)
+
+    def stop(self):
+        """Stop the flush thread and write anything left"""
+        self._stop.set()
+        self.flush()
+
+    def _ensure_thread(self):
+        # The flush thread doesn't survive a fork so start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # Anything buffered before a fork belongs to the parent
+            self._pending = Counter()
+            self._stop = Event()
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
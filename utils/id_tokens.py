@@ -0,0 +1,74 @@
+"""Firebase ID token verification
+Tokens are checked locally against Google's signing certificates rather than with a call to the
+Firebase API. Certificates are cached for as long as their Cache-Control max-age allows and
+tokens that have already been verified are remembered for a short while.
+"""
+
+import re
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+
+class CertificateCache:
+    def __init__(self, url=CERTS_URL):
+        self.url = url
+        self._certs = None
+        self._expires = 0
+        self._lock = Lock()
+
+    def get(self):
+        """Return the signing certificates keyed by key id, fetching them if they've expired"""
+        with self._lock:
+            if self._certs is None or time.monotonic() >= self._expires:
+                try:
+                    certs, max_age = self._fetch()
+                    self._certs = certs
+                    self._expires = time.monotonic() + max_age
+                except Exception as e:
+                    # Keys are published well before they're used so old ones are fine for a while
+                    if self._certs is None:
+                        raise
+                    logging.error(f"Could not refresh signing certificates: {e}")
+            return self._certs
+
+    def _fetch(self):
+        import requests
+        response = requests.get(self.url, timeout=5)
+        response.raise_for_status()
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        return response.json(), int(match.group(1)) if match else 0
+
+
+class TokenVerifier:
+    def __init__(self, project_id, certificates=None, ttl=60, max_tokens=256):
+        """ttl is how long a verified token is trusted without checking it again"""
+        self.project_id = project_id
+        self.certificates = certificates or CertificateCache()
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self._verified = OrderedDict()
+        self._lock = Lock()
+
+    def verify(self, token):
+        """Return the claims of a valid ID token, raising ValueError if it isn't valid"""
+        with self._lock:
+            cached = self._verified.get(token)
+        if cached and cached[0] > time.monotonic() and cached[1]['exp'] > time.time():
+            return cached[1]
+
+        from google.auth import jwt
+        claims = jwt.decode(token, certs=self.certificates.get(), audience=self.project_id)
+        if claims.get('iss') != f'https://securetoken.google.com/{self.project_id}':
+            raise ValueError(f"Token has the wrong issuer {claims.get('iss')}")
+        if not claims.get('sub'):
+            raise ValueError("Token has no subject")
+
+        with self._lock:
+            self._verified[token] = (time.monotonic() + self.ttl, claims)
+            while len(self._verified) > self.max_tokens:
+                self._verified.popitem(last=False)
+        return claims
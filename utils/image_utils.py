@@ -0,0 +1,120 @@
+"""Image resizing and format conversion with Pillow
+Pillow is imported when an image is first resized so it isn't loaded at startup."""
+
+import os
+import base64
+from io import BytesIO
+
+# Formats we can convert to, keyed by the name used in urls
+IMAGE_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+    'png': ('PNG', 'image/png'),
+}
+# Sources we'll convert, gifs are usually animated so they're left alone
+CONVERTIBLE_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+# EXIF orientation tag and the orientations that have the image on its side
+EXIF_ORIENTATION = 0x0112
+SIDEWAYS_ORIENTATIONS = {5, 6, 7, 8}
+# Where the variants made by content_management.thumbnailify are uploaded
+VARIANT_PREFIX = 'images/variants/'
+
+
+def format_for_mimetype(mimetype):
+    """Return the url format name for a mimetype, or None"""
+    for name, (_, format_mimetype) in IMAGE_FORMATS.items():
+        if format_mimetype == mimetype:
+            return name
+    return None
+
+
+def snap_width(width, widths):
+    """Round a requested width up to the nearest allowed width so the number of variants is bounded"""
+    for allowed in sorted(widths):
+        if allowed >= width:
+            return allowed
+    return max(widths)
+
+
+def variant_name(image_name, md5_hash, width, fmt):
+    """Object name of a variant generated when the site is published
+    Includes part of the original's hash so an edited image never matches old variants"""
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    digest = base64.b64decode(md5_hash).hex()[:12]
+    return f'{VARIANT_PREFIX}{stem}-{digest}-{width}w.{fmt}'
+
+
+def get_orientation(im):
+    """EXIF orientation of an opened image, 1 if it's stored the right way up"""
+    return im.getexif().get(EXIF_ORIENTATION, 1)
+
+
+def display_size(im):
+    """Width and height of an opened image once it's turned the right way up"""
+    if get_orientation(im) in SIDEWAYS_ORIENTATIONS:
+        return im.height, im.width
+    return im.width, im.height
+
+
+def scale_image(im, width):
+    """Turn an opened image the right way up and scale it down to a maximum width, keeping the aspect ratio"""
+    from PIL import Image, ImageOps
+    orientation = get_orientation(im)
+    display_width, display_height = display_size(im)
+    size = None
+    if width and width < display_width:
+        size = (width, max(1, round(display_height * width / display_width)))
+        # Draft mode lets the JPEG decoder downscale while decoding, which is much quicker
+        # It works on the image as stored, before it's turned
+        if im.format == 'JPEG':
+            im.draft('RGB', size[::-1] if orientation in SIDEWAYS_ORIENTATIONS else size)
+    # Phones save photos as the sensor saw them with the way up in the EXIF, which isn't kept on save
+    if orientation != 1:
+        im = ImageOps.exif_transpose(im)
+    if size:
+        im = im.resize(size, Image.LANCZOS)
+    return im
+
+
+def encode_image(im, source_format, fmt, quality=80):
+    """Save an image in one of IMAGE_FORMATS, returns the bytes and the mimetype"""
+    pil_format, mimetype = IMAGE_FORMATS[fmt]
+    save_kwargs = {}
+    if pil_format == 'JPEG':
+        im = im.convert('RGB')
+        save_kwargs = {'quality': quality, 'optimize': True, 'progressive': True}
+    elif pil_format == 'WEBP':
+        # Keep pixel art and screenshots crisp, photos can be lossy
+        save_kwargs = {'lossless': True} if source_format == 'PNG' else {'quality': quality}
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA')
+    elif pil_format == 'PNG':
+        save_kwargs = {'optimize': True}
+
+    output = BytesIO()
+    im.save(output, pil_format, **save_kwargs)
+    return output.getvalue(), mimetype
+
+
+def resize_image(data, width=None, fmt=None, quality=80):
+    """Resize image bytes to a maximum width and/or convert them to another format
+    Returns the new bytes and the mimetype"""
+    from PIL import Image
+    im = Image.open(BytesIO(data))
+    source_format = im.format
+    fmt = fmt or format_for_mimetype(Image.MIME.get(source_format)) or 'png'
+    return encode_image(scale_image(im, width), source_format, fmt, quality)
+
+
+def image_variants(data, widths, formats, quality=80):
+    """Yield (width, height, format, bytes) for each width smaller than the image in each format
+    The image is decoded once per width and that decode is shared by the formats"""
+    from PIL import Image
+    for width in sorted(widths, reverse=True):
+        im = Image.open(BytesIO(data))
+        if width >= display_size(im)[0]:
+            continue
+        source_format = im.format
+        im = scale_image(im, width)
+        for fmt in formats:
+            yield width, im.height, fmt, encode_image(im, source_format, fmt, quality)[0]
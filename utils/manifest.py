@@ -0,0 +1,29 @@
+"""Bucket manifest
+An in-memory listing of every object in the content store, built from one list operation.
+Lookups answer existence checks and return blobs with their metadata already loaded.
+"""
+
+
+class BucketManifest:
+    def __init__(self, blobs):
+        self.blobs = {blob.name: blob for blob in blobs}
+
+    def __eq__(self, other):
+        # Two listings are the same if every object has the same generation
+        if not isinstance(other, BucketManifest):
+            return NotImplemented
+        return self.generations() == other.generations()
+
+    def __contains__(self, name):
+        return name in self.blobs
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def get(self, name):
+        """Return the blob with this name or None"""
+        return self.blobs.get(name)
+
+    def generations(self):
+        return {name: blob.generation for name, blob in self.blobs.items()}
+
@@ -0,0 +1,139 @@
+"""Request timing and metrics
+Phases of a request (GCS, Firestore, markdown, templates) are timed into flask.g for the
+Server-Timing header and into per-process histograms exposed in Prometheus text format.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_app_context
+
+# Latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix='homepage'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = []
+        self.help = {}
+        self._lock = Lock()
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, fn, help=None):
+        """Register a gauge read when metrics are rendered
+        fn returns a number, or a dictionary of label dictionaries (as tuples of items) to numbers"""
+        self.gauges.append((name, fn))
+        if help:
+            self.help[name] = help
+
+    def render(self):
+        """Render everything in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        seen = set()
+        for (name, labels), histogram in histograms:
+            full_name = f'{self.prefix}_{name}'
+            if full_name not in seen:
+                seen.add(full_name)
+                lines.append(f'# TYPE {full_name} histogram')
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{full_name}_bucket{format_labels(labels + (("le", bucket),))} {cumulative}')
+            lines.append(f'{full_name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+            lines.append(f'{full_name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{full_name}_count{format_labels(labels)} {histogram.count}')
+
+        for (name, labels), value in counters:
+            full_name = f'{self.prefix}_{name}'
+            if full_name not in seen:
+                seen.add(full_name)
+                lines.append(f'# TYPE {full_name} counter')
+            lines.append(f'{full_name}{format_labels(labels)} {value}')
+
+        for name, fn in self.gauges:
+            full_name = f'{self.prefix}_{name}'
+            if name in self.help:
+                lines.append(f'# HELP {full_name} {self.help[name]}')
+            lines.append(f'# TYPE {full_name} gauge')
+            value = fn()
+            if isinstance(value, dict):
+                for labels, labelled_value in value.items():
+                    lines.append(f'{full_name}{format_labels(labels)} {labelled_value}')
+            else:
+                lines.append(f'{full_name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+metrics = Metrics()
+
+
+def get_timings():
+    """Return the list of (phase, seconds) recorded for the current request"""
+    if 'timings' not in g:
+        g.timings = []
+    return g.timings
+
+
+@contextmanager
+def timed(phase):
+    """Time a phase of the request, can be used as a decorator too"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        duration = perf_counter() - start
+        metrics.observe('phase_duration_seconds', duration, phase=phase)
+        if has_app_context():
+            get_timings().append((phase, duration))
+
+
+def server_timing_header(timings):
+    """Format timings as a Server-Timing header, summing repeated phases"""
+    totals = {}
+    for phase, duration in timings:
+        totals[phase] = totals.get(phase, 0) + duration
+    return ', '.join(f'{phase};dur={duration * 1000:.1f}' for phase, duration in totals.items())
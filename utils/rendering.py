@@ -0,0 +1,87 @@
+"""Markdown rendering
+Turns content markdown into metadata, html and track listings. The app renders with these and
+update_site uses them to pre-render artifacts that are uploaded next to each markdown file,
+so the app can skip rendering anything that hasn't changed since it was published.
+"""
+
+import json
+
+from utils.md_parser import markdown_parser
+from utils.front_matter import parse_metadata, split_front_matter, split_sections
+
+# Bump this when rendering changes so old artifacts are rendered again
+RENDER_VERSION = 1
+
+
+def render_markdown(md, blob_name):
+    """Parse markdown text into metadata and rendered content"""
+    # We can capture the section between --- and --- and use it as metadata
+    metadata, content = split_front_matter(md)
+    metadata = parse_metadata(metadata, blob_name)
+    content = markdown_parser.convert(content)
+
+    return metadata, content
+
+def render_music(md, blob_name):
+    """Parse music markdown text into metadata, content and track listing"""
+    # Split on --- to get metadata, content and track listing
+    sections = split_sections(md)
+    metadata = parse_metadata(sections[1], blob_name)
+    content = markdown_parser.convert(sections[2])
+    track_listing = parse_track_listing(sections[3])
+
+    # Now we need to return a dict with metadata, content and track listing
+    return {
+        'metadata': metadata,
+        'content': content,
+        'track_listing': track_listing
+    }
+
+def parse_track_listing(track_listing):
+    """Parse a track listing string into a list of dictionaries with title and file"""
+    lines = track_listing.split('\n')
+
+    # Strip any empty lines
+    lines = [line for line in lines if line]
+
+    tracks = []
+    for i in range(0, len(lines), 2):
+        title = lines[i].replace('title:', '').strip()
+        file = lines[i+1].replace('file:', '').strip()
+        tracks.append(
+            {
+                'title': title,
+                'file': file
+            }
+        )
+
+    return tracks
+
+RENDERERS = {
+    'markdown': render_markdown,
+    'music': render_music,
+}
+
+def artifact_name(blob_name):
+    """Return the name of the pre-rendered artifact stored next to a markdown file"""
+    return f'{blob_name}.json'
+
+def build_artifact(md, blob_name, md5_hash, kinds):
+    """Render markdown ahead of time with each renderer in kinds
+    md5_hash is the hash of the source so a stale artifact can be spotted"""
+    return {
+        'version': RENDER_VERSION,
+        'source_md5': md5_hash,
+        'renders': {kind: RENDERERS[kind](md, blob_name) for kind in kinds},
+    }
+
+def read_artifact(data, kind, md5_hash):
+    """Return a render from an artifact, or None if it was rendered from a different source or version"""
+    artifact = json.loads(data)
+    if artifact.get('version') != RENDER_VERSION or artifact.get('source_md5') != md5_hash:
+        return None
+    rendered = artifact.get('renders', {}).get(kind)
+    # JSON turns the (metadata, content) tuple into a list
+    if kind == 'markdown' and rendered is not None:
+        rendered = tuple(rendered)
+    return rendered
@@ -0,0 +1,59 @@
+"""RSS feed generation"""
+
+import hashlib
+from functools import lru_cache
+from datetime import datetime as dt
+
+import pytz
+from feedgen.feed import FeedGenerator
+
+
+@lru_cache(maxsize=4096)
+def parse_feed_date(date):
+    """Parse a feed timestamp key and localise it to London"""
+    return pytz.timezone('Europe/London').localize(dt.strptime(date, "%Y-%m-%d %H:%M:%S"))
+
+def get_enclosure_type(image):
+    # Ext should be jpg or png - get mimetype from the extension
+    ext = image.split('.')[-1]
+    mime_type = f'image/{ext}'.lower()
+    # If it says jpg then it should be jpeg
+    if ext.lower() == 'jpg':
+        mime_type = 'image/jpeg'
+    return mime_type
+
+def build_rss(entries, base_url, newest=None):
+    """Build an RSS document from feed index entries, newest first
+    newest is the date of the latest entry in the whole feed, used when a filter matches nothing
+    Returns the serialised feed, an etag and the last modified date"""
+    feed = FeedGenerator()
+    feed.id(base_url)
+    feed.title('Edward Atkin\'s Homepage')
+    feed.link(href=base_url, rel='alternate')
+    feed.description('The personal website of Edward Atkin')
+    feed.language('en')
+    feed.ttl(3600)
+
+    # Get the latest date for the feed last build date
+    # An empty feed still needs a fixed one or feedgen stamps the current time and the etag changes every build
+    date = entries[0]['date'] if entries else newest
+    last_modified = parse_feed_date(date) if date else None
+    if last_modified:
+        feed.lastBuildDate(last_modified)
+
+    # Feedgen expects oldest first so we need to reverse the data shrug emoji
+    for v in entries[::-1]:
+        # Create an entry for each item in the feed
+        entry = feed.add_entry()
+        entry.id(f'{base_url}{v["url"]}')
+        entry.title(v['title'])
+        entry.link(href=f'{base_url}{v["url"]}', rel='alternate')
+        entry.description(v['description'])
+        entry.pubDate(parse_feed_date(v['date']))
+
+        if 'og_image' in v:
+            entry.enclosure(f'{base_url[:-1]}{v["og_image"]}', 0, get_enclosure_type(v['og_image']))
+
+    rss_str = feed.rss_str(pretty=True)
+    etag = hashlib.sha1(rss_str).hexdigest()
+    return rss_str, etag, last_modified
@@ -0,0 +1,277 @@
+"""Content and metadata backends
+ContentStore serves the markdown, images and music, MetadataStore serves the feed,
+collections, recommendations and hit counter documents.
+
+The GCS and Firestore stores are what the site runs on. The local stores read a directory
+and JSON files instead, for self hosting and for running without any cloud access.
+Cloud libraries are only imported and clients only created on first use, and clients are
+recreated in a forked worker since gRPC channels can't be shared across a fork.
+"""
+
+import os
+import json
+import mmap
+import fcntl
+import mimetypes
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock
+
+from utils.hashing import file_md5_base64
+
+
+class ContentStore:
+    def get_object(self, name):
+        """Return the object with this name, with its metadata loaded, or None"""
+        raise NotImplementedError
+
+    def list_objects(self):
+        """Return every object in the store"""
+        raise NotImplementedError
+
+    def local_path(self, obj):
+        """Return a filesystem path for an object if it can be served straight from disk"""
+        return None
+
+
+class MetadataStore:
+    def get_document(self, collection, document):
+        """Return a document as a dictionary, or None if it doesn't exist"""
+        raise NotImplementedError
+
+    def list_documents(self, collection):
+        """Return every document in a collection keyed by id"""
+        raise NotImplementedError
+
+    def set_document(self, collection, document, data, merge=False):
+        raise NotImplementedError
+
+    def increment(self, collection, document, deltas):
+        """Add deltas ({field: amount}) to numeric fields of a document"""
+        raise NotImplementedError
+
+    def watch_document(self, collection, document, on_change):
+        """Call on_change with the new data whenever the document changes
+        Returns something with unsubscribe(), or None if changes can't be watched"""
+        return None
+
+    def watch_collection(self, collection, on_change):
+        """Call on_change with every document whenever any document in a collection changes"""
+        return None
+
+
+class GCSContentStore(ContentStore):
+    # Only list the metadata we use, it keeps the listing small
+    LIST_FIELDS = 'items(name,size,generation,contentType,md5Hash,etag,updated),nextPageToken'
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self._bucket = None
+        self._pid = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None or self._pid != os.getpid():
+            from google.cloud import storage
+            self._bucket = storage.Client().bucket(self.bucket_name)
+            self._pid = os.getpid()
+        return self._bucket
+
+    def get_object(self, name):
+        return self.bucket.get_blob(name)
+
+    def list_objects(self):
+        return self.bucket.list_blobs(fields=self.LIST_FIELDS)
+
+
+class FirestoreMetadataStore(MetadataStore):
+    def __init__(self):
+        self._db = None
+        self._pid = None
+
+    @property
+    def db(self):
+        if self._db is None or self._pid != os.getpid():
+            from firebase_admin import firestore, initialize_app
+            try:
+                initialize_app()
+            except ValueError:
+                # Already initialised
+                pass
+            self._db = firestore.client()
+            self._pid = os.getpid()
+        return self._db
+
+    def get_document(self, collection, document):
+        return self.db.collection(collection).document(document).get().to_dict()
+
+    def list_documents(self, collection):
+        return {doc.id: doc.to_dict() for doc in self.db.collection(collection).stream()}
+
+    def set_document(self, collection, document, data, merge=False):
+        self.db.collection(collection).document(document).set(data, merge=merge)
+
+    def increment(self, collection, document, deltas):
+        from firebase_admin import firestore
+        increments = {key: firestore.Increment(count) for key, count in deltas.items()}
+        self.db.collection(collection).document(document).set(increments, merge=True)
+
+    def watch_document(self, collection, document, on_change):
+        def on_snapshot(docs, changes, read_time):
+            for doc in docs:
+                on_change(doc.to_dict())
+        return self.db.collection(collection).document(document).on_snapshot(on_snapshot)
+
+    def watch_collection(self, collection, on_change):
+        def on_snapshot(docs, changes, read_time):
+            on_change({doc.id: doc.to_dict() for doc in docs})
+        return self.db.collection(collection).on_snapshot(on_snapshot)
+
+
+class LocalBlob:
+    """A file in a LocalContentStore with the parts of the GCS Blob interface the app uses"""
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        # The modified time stands in for the GCS generation
+        self.generation = stat.st_mtime_ns
+        self.etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+        self.updated = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self._md5_hash = None
+
+    @property
+    def md5_hash(self):
+        # Base64 like GCS, only worked out if someone asks
+        if self._md5_hash is None:
+            self._md5_hash = file_md5_base64(self.path)
+        return self._md5_hash
+
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        """Read the file, or bytes start to end inclusive"""
+        start = start or 0
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(max(0, end - start + 1))
+
+    def download_as_string(self, **kwargs):
+        return self.download_as_bytes(**kwargs)
+
+    def open(self, mode='rb', **kwargs):
+        """Open the file for ranged reads, which come from a memory map"""
+        if self.size == 0:
+            # Empty files can't be mapped
+            return open(self.path, mode)
+        with open(self.path, 'rb') as f:
+            # The map stays valid once the file is closed
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LocalContentStore(ContentStore):
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+
+    def _path(self, name):
+        path = os.path.realpath(os.path.join(self.root, name))
+        # Don't let names like ../ escape the content directory
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def get_object(self, name):
+        path = self._path(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        return LocalBlob(name, path)
+
+    def list_objects(self):
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for file in files:
+                if file.startswith('.'):
+                    continue
+                path = os.path.join(root, file)
+                yield LocalBlob(os.path.relpath(path, self.root).replace(os.sep, '/'), path)
+
+    def local_path(self, obj):
+        return getattr(obj, 'path', None)
+
+
+class LocalMetadataStore(MetadataStore):
+    """Documents stored as JSON files, <root>/<collection>/<document>.json"""
+    def __init__(self, root):
+        self.root = root
+        self._lock = Lock()
+
+    def _path(self, collection, document):
+        return os.path.join(self.root, collection, f'{document}.json')
+
+    def get_document(self, collection, document):
+        try:
+            with open(self._path(collection, document), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list_documents(self, collection):
+        directory = os.path.join(self.root, collection)
+        if not os.path.isdir(directory):
+            return {}
+        return {
+            file[:-5]: self.get_document(collection, file[:-5])
+            for file in sorted(os.listdir(directory)) if file.endswith('.json')
+        }
+
+    def set_document(self, collection, document, data, merge=False):
+        with self._locked(collection, document):
+            self._write(collection, document, data, merge)
+
+    def increment(self, collection, document, deltas):
+        with self._locked(collection, document):
+            data = self.get_document(collection, document) or {}
+            for key, count in deltas.items():
+                data[key] = data.get(key, 0) + count
+            self._write(collection, document, data)
+
+    def _write(self, collection, document, data, merge=False):
+        if merge:
+            data = {**(self.get_document(collection, document) or {}), **data}
+        path = self._path(collection, document)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+
+    @contextmanager
+    def _locked(self, collection, document):
+        """Lock a document against other threads and other worker processes"""
+        path = self._path(collection, document) + '.lock'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock, open(path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def create_content_store(backend, bucket_name=None, directory=None):
+    """Create a content store from the CONTENT_BACKEND setting"""
+    if backend == 'local':
+        return LocalContentStore(directory)
+    if backend == 'gcs':
+        return GCSContentStore(bucket_name)
+    raise ValueError(f"Unknown content backend {backend}")
+
+
+def create_metadata_store(backend, directory=None):
+    """Create a metadata store from the METADATA_BACKEND setting"""
+    if backend == 'local':
+        return LocalMetadataStore(directory)
+    if backend == 'firestore':
+        return FirestoreMetadataStore()
+    raise ValueError(f"Unknown metadata backend {backend}")
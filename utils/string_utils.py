@@ -2,3 +2,11 @@ import string
 
 def strip_punctuation(s):
     return s.translate(str.maketrans('', '', string.punctuation))
+
+def clean_tags(tags):
+    """Clean a tag string"""
+    return [strip_punctuation(tag).strip().lower().replace(' ', '-') for tag in tags.split(',')]
+
+def clean_collection_name(collection):
+    """Lowercase a collection name, strip punctuation and replace spaces with underscores"""
+    return strip_punctuation(collection).replace(' ', '_').lower()